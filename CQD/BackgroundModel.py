@@ -0,0 +1,190 @@
+import numpy as np
+from CQD.Resampler import grid_key, padded, resampler_for, same_grid
+
+
+class BackgroundModel:
+    """
+    Immutable set of background spectra used for background subtraction of CQDSpectrum objects.
+    The public attributes and arrays are read-only. Backgrounds derived from them, interpolated gains and backgrounds
+    resampled onto other wavelengths, are memoized in the private _cache on first use, one entry per gain and
+    wavelength grid met. The memoized values depend only on the spectra of the model, so a model can be shared by
+    threads, at worst computing an entry twice. with_gains() precomputes the interpolated gains.
+    The absorbance background is a single spectrum. The fluorescence background has one spectrum per excitation
+    wavelength and gain, spectra for other gains are interpolated linearly between the neighbouring gains.
+    Backgrounds are resampled onto the wavelengths of the spectra they are subtracted from if these differ.
+    New models are derived with with_absorbance() and with_fluorescence().
+    """
+    def __init__(self, abs_x=None, abs_y=None, flu_x=None, flu_ys=None):
+        """
+        :param abs_x: numpy array of wavelength values of the absorbance background
+        :param abs_y: numpy array of absorbance background values
+        :param flu_x: dict{ex_wl: numpy array} wavelength values of the fluorescence backgrounds
+        :param flu_ys: dict{ex_wl: dict{gain: dict{key: numpy array}}} fluorescence background spectra
+        """
+        d = self.__dict__
+        d['abs_x'] = _frozen(abs_x)
+        d['abs_y'] = _frozen(abs_y)
+        d['flu_x'] = {ex_wl: _frozen(x) for ex_wl, x in (flu_x or {}).items()}
+        d['flu_ys'] = {ex_wl: {gain: {k: _frozen(y) for k, y in by_gain[gain].items()} for gain in sorted(by_gain)}
+                       for ex_wl, by_gain in (flu_ys or {}).items()}
+        # (ex_wl, gain) -> background y-vectors, exact gains precomputed, interpolated gains added on first use.
+        # Backgrounds resampled onto other wavelengths are added with the grid_key() of the wavelengths appended.
+        d['_cache'] = {(ex_wl, gain): ys for ex_wl, by_gain in self.flu_ys.items() for gain, ys in by_gain.items()}
+
+    def __setattr__(self, name, value):
+        raise AttributeError('BackgroundModel is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('BackgroundModel is immutable')
+
+    def __repr__(self):
+        return '<BackgroundModel abs:{} fluorescence gains:{}>'.format(
+            self.abs_x is not None, {ex_wl: list(by_gain.keys()) for ex_wl, by_gain in self.flu_ys.items()})
+
+    def with_absorbance(self, abs_x, abs_y):
+        """
+        :param abs_x: numpy array of wavelength values
+        :param abs_y: numpy array of absorbance background values
+        :return: new BackgroundModel with the absorbance background replaced
+        """
+        return BackgroundModel(abs_x, abs_y, self.flu_x, self.flu_ys)
+
+    def with_fluorescence(self, spectra):
+        """
+        :param spectra: list of CQDSpectrum from the fluorescence baseline file. Spectra measured at other
+            wavelengths than the first spectrum of their excitation wavelength are resampled onto its wavelengths.
+        :return: new BackgroundModel with the spectra added to the fluorescence background
+        """
+        flu_x = dict(self.flu_x)
+        flu_ys = {ex_wl: dict(by_gain) for ex_wl, by_gain in self.flu_ys.items()}
+        for spectrum in spectra:
+            ex_wl = spectrum.meta_data['ex_wl']
+            if ex_wl not in (350, 400):
+                raise ValueError('Spectrum with invalid wavelength {} in "Fluorescence baseline.xlsx" file'.
+                                 format(ex_wl))
+            if ex_wl not in flu_x:
+                flu_x[ex_wl] = spectrum.wl_vector
+            resampler = resampler_for(flu_x[ex_wl])
+            flu_ys.setdefault(ex_wl, {})[spectrum.meta_data['gain']] = {
+                k: resampler.resample(spectrum.wl_vector, padded(y, len(spectrum.wl_vector)))
+                for k, y in spectrum.y_vectors.items()}
+        return BackgroundModel(self.abs_x, self.abs_y, flu_x, flu_ys)
+
+    def with_gains(self, keys):
+        """
+        :param keys: iterable of (ex_wl, gain) of the spectra the model will be used for
+        :return: new BackgroundModel with the interpolated fluorescence backgrounds precomputed for the keys
+        """
+        model = BackgroundModel(self.abs_x, self.abs_y, self.flu_x, self.flu_ys)
+        for ex_wl, gain in keys:
+            if ex_wl in model.flu_x:
+                model.fluorescence_background(ex_wl, gain)
+        return model
+
+    def absorbance_background(self, wl_vector=None):
+        """
+        :param wl_vector: optional wavelengths to resample the background onto
+        :return: Numpy.array, None if the absorbance background is not initialized
+        """
+        if self.abs_x is None or wl_vector is None or same_grid(wl_vector, self.abs_x):
+            return self.abs_y
+        key = ('abs', grid_key(wl_vector))
+        if key not in self._cache:
+            self._cache[key] = _frozen(resampler_for(wl_vector).resample(self.abs_x, self.abs_y))
+        return self._cache[key]
+
+    def fluorescence_background(self, ex_wl, gain, wl_vector=None):
+        """
+        Fluorescence background for an excitation wavelength and gain.
+        Gains between the gains of the background spectra are linearly interpolated.
+        :param ex_wl: excitation wavelength, 350 or 400
+        :param gain: gain of the spectrum
+        :param wl_vector: optional wavelengths to resample the background onto
+        :return: dict{key: Numpy.array}, None if gain is out of range of the background spectra
+        """
+        if wl_vector is not None and ex_wl in self.flu_x and not same_grid(wl_vector, self.flu_x[ex_wl]):
+            key = (ex_wl, gain, grid_key(wl_vector))
+            if key not in self._cache:
+                bg_ys = self.fluorescence_background(ex_wl, gain)
+                resampler = resampler_for(wl_vector)
+                self._cache[key] = None if bg_ys is None else {
+                    k: _frozen(resampler.resample(self.flu_x[ex_wl], y)) for k, y in bg_ys.items()}
+            return self._cache[key]
+
+        # Gains not precomputed with with_gains() are computed on first use and memoized
+        key = (ex_wl, gain)
+        if key in self._cache:
+            return self._cache[key]
+
+        if ex_wl not in (350, 400):
+            raise ValueError('No background spectra for excitation wavelength {}'.format(ex_wl))
+        if ex_wl not in self.flu_x:
+            raise ValueError('Background spectra ex{} is not initialized'.format(ex_wl))
+        bg_ys = self.flu_ys[ex_wl]
+
+        keys = list(bg_ys.keys())
+        try:
+            over = min([x for x in keys if x > gain])
+            under = max([x for x in keys if x < gain])
+        except ValueError:
+            combined = None
+        else:
+            combined = {}
+            for k in bg_ys[under].keys():
+                low = bg_ys[under][k]
+                high = bg_ys[over][k]
+                combined[k] = _frozen(low + (high-low) * ((gain-under)/(over-under)))
+        # Plain dict assignment, safe when several threads share the model
+        self._cache[key] = combined
+        return combined
+
+    def subtract(self, spectrum, spec_key=None):
+        """
+        Performs background subtraction of a spectrum, see CQDSpectrum.subtracted()
+        :param spectrum: CQDSpectrum
+        :param spec_key: optional y_vectors key
+        :return: dict{key: Numpy.array} or Numpy.array if spec_key specified
+        """
+        spectra = spectrum.y_vectors
+        if spec_key is not None:
+            spectra = {spec_key: spectrum.y_vectors[spec_key]}
+
+        # Absorbance spectrum
+        if 'gain' not in spectrum.meta_data:
+            if self.abs_x is None:
+                raise ValueError('Background spectrum is not initialized')
+
+            bg_y = _cut(self.absorbance_background(spectrum.wl_vector), spectra['Abs'])
+            if spec_key is not None:
+                return spectra['Abs'] - bg_y
+            return {'Abs': spectra['Abs'] - bg_y}
+
+        # Fluorescence spectrum
+        bg_ys = self.fluorescence_background(spectrum.meta_data['ex_wl'], spectrum.meta_data['gain'],
+                                             spectrum.wl_vector)
+        if bg_ys is None:
+            print('Sample gain={} out of range for subtraction. Returning original spectra.'
+                  .format(spectrum.meta_data['gain']))
+            return spectra
+
+        subbed = {}
+        for k in spectra.keys():
+            subbed[k] = spectra[k]-_cut(bg_ys[k], spectra[k])
+
+        if spec_key is not None:
+            return subbed[spec_key]
+        return subbed
+
+
+def _frozen(a):
+    # Read-only copy of an array, None stays None
+    if a is None:
+        return None
+    a = np.array(a, dtype=float)
+    a.setflags(write=False)
+    return a
+
+
+def _cut(bg_y, y):
+    # Background on the wavelengths of a y-vector cut at the first blank cell, see Resampler.padded()
+    return bg_y[:len(y)] if len(y) < len(bg_y) else bg_y
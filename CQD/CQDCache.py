@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import re
+import time
+import zipfile
+import numpy as np
+from CQD.CQDSample import CQDSample
+from CQD.CQDSpectrum import CQDSpectrum
+from CQD.CQDSpectralStore import CQDSpectralStore, SpectrumTable
+from CQD.BackgroundModel import BackgroundModel
+from CQD.LazySpectra import LazySpectra, SpectrumLoader
+from CQD.CQDReaders import read_shared_strings, workbook_sheet_members
+
+# Bump when the layout of the cache directory changes
+cache_version = 4
+manifest_name = 'manifest.json'
+time_keys = ('start_t', 'end_t')
+# Index into the shared strings table of a shared string cell, <c r="A1" t="s"><v>3</v></c>
+shared_string_ref = re.compile(rb'(<(?:\w+:)?c\b[^>]*?\bt="s"[^>]*>\s*<(?:\w+:)?v>)(\d+)(?=<)')
+
+
+def file_fingerprint(path):
+    """
+    :param path: path to input file
+    :return: dict with size, mtime and sha256 content hash of the file
+    """
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': file_hash(path)}
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def sheet_hashes(xlsx_path):
+    """
+    Content hashes of the worksheets of an .xlsx workbook, computed from the worksheet xml in the zip archive
+    without parsing the cells. Shared string cells are hashed with their text in place of the index into the
+    shared strings table, so text added to or removed from another sheet does not change the hash.
+    :param xlsx_path: path to .xlsx file
+    :return: dict{sheet name: sha256}
+    """
+    with zipfile.ZipFile(xlsx_path) as z:
+        shared = [b'%d:' % len(t) + t for t in (t.encode('utf-8') for t in read_shared_strings(z))]
+
+        def resolve(m):
+            i = int(m.group(2))
+            return m.group(1) + (shared[i] if i < len(shared) else m.group(2))
+
+        hashes = {}
+        for sheet_name, member in workbook_sheet_members(z):
+            h = hashlib.sha256()
+            tail = b''
+            with z.open(member) as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    # Hashed up to the last closing tag, a cell cut by the chunk boundary is completed by the next chunk
+                    buf = tail + chunk
+                    cut = buf.rfind(b'</') + 1
+                    h.update(shared_string_ref.sub(resolve, buf[:cut]))
+                    tail = buf[cut:]
+            h.update(tail)
+            hashes[sheet_name] = h.hexdigest()
+    return hashes
+
+
+def fingerprint_matches(path, fingerprint):
+    """
+    Check a file against a stored fingerprint. The content hash is only computed when size matches but mtime differs.
+    :param path: path to input file
+    :param fingerprint: dict from file_fingerprint()
+    :return: True if the file is unchanged
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != fingerprint['size']:
+        return False
+    if st.st_mtime_ns == fingerprint['mtime']:
+        return True
+    return file_hash(path) == fingerprint['sha256']
+
+
+def save_collection(collection, cache_dir, input_paths):
+    """
+    Write the parsed collection to a cache directory. Spectra are stored as .npy arrays, one per spectrum type
+    with its wavelengths and 'OVER' mask, sample metadata and spectrum metadata as json. Spectra are cached as
+    parsed, not resampled, so ValueError is raised if the spectra of a type are not all on one wavelength grid.
+    :param collection: CQDCollection to cache
+    :param cache_dir: directory to write the cache to
+    :param input_paths: paths of the input files the collection was parsed from
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, manifest_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)  # invalidate the old cache while the new one is written
+
+    store = collection.store
+    if store is None or any(t.resampled.any() for t in store.tables.values()):
+        store = CQDSpectralStore.from_samples(collection.samples, resample=False)
+    sample_rows = {id(s): i for i, s in enumerate(collection.samples)}
+
+    tables = {}
+    for spec_type, table in store.tables.items():
+        np.save(os.path.join(cache_dir, spec_type + '.npy'), table.data)
+        np.save(os.path.join(cache_dir, spec_type + '_wl.npy'), table.wl_vector)
+        np.save(os.path.join(cache_dir, spec_type + '_over.npy'), table.over)
+        tables[spec_type] = {'channels': list(table.channels),
+                             'samples': [sample_rows[id(s)] for s in table.samples],
+                             'meta_data': [_meta_to_json(m) for m in table.meta_data]}
+    # Spectra that could not be parsed are stored as None in CQDSample.spectra
+    empty = [[i, k] for i, s in enumerate(collection.samples) for k, v in s.spectra.items() if v is None]
+
+    background = collection.background
+    bg = {}
+    if background.abs_x is not None:
+        bg['abs_x'] = background.abs_x
+        bg['abs_y'] = background.abs_y
+    for ex_wl, x in background.flu_x.items():
+        ys = background.flu_ys[ex_wl]
+        bg['ex{}_x'.format(ex_wl)] = x
+        bg['ex{}_ys'.format(ex_wl)] = np.array([list(by_key.values()) for by_key in ys.values()])
+    np.savez(os.path.join(cache_dir, 'background.npz'), **bg)
+    bg_channels = {ex_wl: list(next(iter(ys.values())).keys()) for ex_wl, ys in background.flu_ys.items()}
+    bg_gains = {ex_wl: list(ys.keys()) for ex_wl, ys in background.flu_ys.items()}
+
+    manifest = {'version': cache_version,
+                'inputs': {os.path.abspath(p): file_fingerprint(p) for p in input_paths},
+                'samples': [[s.label, s.plate, s.well, s.klass, s.comment, s.reactants, list(s.spectra.keys())]
+                            for s in collection.samples],
+                'tables': tables,
+                'empty_spectra': empty,
+                'background': {'channels': bg_channels, 'gains': bg_gains},
+                'fingerprints': collection.fingerprints}
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_collection(cache_dir, input_paths, lazy=False, max_resident=256):
+    """
+    Load a collection from a cache directory written by save_collection().
+    Spectrum arrays are memory mapped copy-on-write.
+    :param cache_dir: cache directory
+    :param input_paths: paths of the input files, the cache is only used if none of them have changed
+    :param lazy: if True the .spectra of the samples are LazySpectra, spectra are materialized from the memory
+        mapped store when accessed and the store is not attached to them
+    :param max_resident: maximum number of materialized spectra kept in memory if lazy
+    :return: CQDCollection instance with .store populated, or None if the cache is missing or stale
+    """
+    # Imported here, CQDCollection imports this module
+    from CQD.CQDCollection import CQDCollection
+
+    manifest_path = os.path.join(cache_dir, manifest_name)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != cache_version:
+        return None
+    inputs = manifest['inputs']
+    if sorted(inputs.keys()) != sorted(os.path.abspath(p) for p in input_paths):
+        return None
+    if not all(fingerprint_matches(p, inputs[os.path.abspath(p)]) for p in input_paths):
+        return None
+
+    self = CQDCollection()
+    for label, plate, well, klass, comment, reactants, _ in manifest['samples']:
+        self.add_sample(CQDSample(label, plate, well, klass, comment, reactants))
+
+    tables = {}
+    rows = [{} for _ in self.samples]  # spectrum type -> store row of each sample, None for empty spectra
+    for spec_type, t in manifest['tables'].items():
+        data = np.load(os.path.join(cache_dir, spec_type + '.npy'), mmap_mode='c')
+        wl_vector = np.load(os.path.join(cache_dir, spec_type + '_wl.npy'))
+        over = np.load(os.path.join(cache_dir, spec_type + '_over.npy'), mmap_mode='c')
+        samples = [self.samples[i] for i in t['samples']]
+        meta_data = [_meta_from_json(m) for m in t['meta_data']]
+        for row, i in enumerate(t['samples']):
+            rows[i][spec_type] = row
+        tables[spec_type] = SpectrumTable(spec_type, tuple(t['channels']), wl_vector, data, samples, meta_data,
+                                          over=over)
+    for i, spec_type in manifest['empty_spectra']:
+        rows[i][spec_type] = None
+    self.store = CQDSpectralStore(tables)
+
+    # Restore the spectra order of each sample
+    if lazy:
+        self.spectrum_loader = SpectrumLoader(self.store, max_resident)
+        for samp, sample_rows, (*_, spec_keys) in zip(self.samples, rows, manifest['samples']):
+            samp.spectra = LazySpectra(self.spectrum_loader, {k: sample_rows[k] for k in spec_keys})
+    else:
+        for samp, sample_rows, (*_, spec_keys) in zip(self.samples, rows, manifest['samples']):
+            samp.spectra = {k: None if sample_rows[k] is None else
+                            CQDSpectrum(tables[k].wl_vector, None, tables[k].meta_data[sample_rows[k]])
+                            for k in spec_keys}
+        self.store.attach()
+
+    with np.load(os.path.join(cache_dir, 'background.npz')) as bg:
+        flu_x = {}
+        flu_ys = {}
+        for ex_wl, channels in manifest['background']['channels'].items():
+            key = 'ex{}'.format(ex_wl)
+            flu_x[int(ex_wl)] = bg[key + '_x']
+            flu_ys[int(ex_wl)] = {gain: {k: y[c] for c, k in enumerate(channels)}
+                                  for gain, y in zip(manifest['background']['gains'][ex_wl], bg[key + '_ys'])}
+        background = BackgroundModel(bg['abs_x'] if 'abs_x' in bg else None,
+                                     bg['abs_y'] if 'abs_y' in bg else None, flu_x, flu_ys)
+    self.set_background(background)
+    self.fingerprints = manifest['fingerprints']
+    return self
+
+
+def _meta_to_json(meta_data):
+    return {k: list(v) if k in time_keys else v for k, v in meta_data.items()}
+
+
+def _meta_from_json(meta_data):
+    return {k: time.struct_time(v) if k in time_keys else v for k, v in meta_data.items()}
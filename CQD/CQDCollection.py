@@ -1,10 +1,38 @@
+import hashlib
 import os.path
 import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from openpyxl import load_workbook
-from xlrd import open_workbook, XLRDError
 from CQD.CQDSpectrum import CQDSpectrum
-from CQD.CQDSample import CQDSample
+from CQD.CQDSample import CQDSample, write_workbook
+from CQD.CQDSpectralStore import CQDSpectralStore
+from CQD.BackgroundModel import BackgroundModel
+from CQD.LazySpectra import LazySpectra
+from CQD.PipelineStats import PipelineStats
+from CQD.CQDReaders import open_reader
+from CQD.SpectralIndex import SpectralIndex
+from CQD import CQDCache, CQDExport, CQDPeaks, CQDQuench
+
+# Spectrum types measured for every sample, see parse_spectrometer_label
+spectrum_types = ('abs', 'ex350', 'ex400')
+
+# Comments in the map file marking blank samples, their absorbance spectra make up the absorbance background
+blank_sample_comments = ['no sample in eppendorfrör (analysis is of water only)',
+                         'sample missing (analysis is of water only)',
+                         'Eppendorfrör empty - analysis is of water only',
+                         'sample and protokoll missing (analysis is of water only)',
+                         'sample missing - analysis is of water only',
+                         'No sample, synthesis did not work - analysis is of water only',
+                         'reference sample with only water']
+# Categories of the map file comments, see comment_category()
+comment_categories = ('blank', 'note', 'none')
+
+# Result of CQDCollection.qc_report()
+QCReport = namedtuple('QCReport', ['missing', 'saturation'])
+# Result of CQDCollection.refresh()
+RefreshReport = namedtuple('RefreshReport', ['plates', 'added', 'removed', 'updated', 'background'])
 
 
 class CQDCollection:
@@ -15,11 +43,25 @@ class CQDCollection:
 
     def __init__(self):
         self.samples = []
+        self.well_index = {}  # (plate, well) -> list of samples at that position
+        self.label_index = {}  # label -> list of samples with that label
+        self.klass_index = {}  # klass -> list of samples produced by that school class
+        self.plate_index = {}  # plate -> list of samples on that plate
+        self.reactant_index = {}  # reactant -> list of samples made with that reactant
+        self.comment_index = {}  # comment category -> list of samples, see comment_category()
+        self.position_index = {}  # id(sample) -> index of the sample in self.samples
+        self.store = None  # optional CQDSpectralStore holding the spectra in columnar form
+        self.background = BackgroundModel()  # background spectra used by the spectra of this collection
+        self.fingerprints = None  # content hashes of the input files per worksheet and plate, see refresh()
+        self.spectrum_loader = None  # SpectrumLoader of the samples' LazySpectra if loaded lazily
+        self.stats = PipelineStats(enabled=False)  # stage timings and counters, see read_from_dir()
+        self.backend = None  # reader backend of the measurement workbook, see CQDReaders.open_reader()
         self.cqd1_book = None
         self.qcd2_book = None
 
     @classmethod
-    def read_from_dir(cls, path):
+    def read_from_dir(cls, path, columnar=False, cache_dir=None, workers=None, lazy=False, max_resident=256,
+                      stats=None, backend=None):
         """
         Read data from a directory containing files:
             'CQD_measurements1.xls',
@@ -27,31 +69,50 @@ class CQDCollection:
             'Well plate map.xlsx',
             'Plate to Excel sheet.xlsx',
         :param path: path to directory
+        :param columnar: if True pack the spectra into a CQDSpectralStore, see build_store()
+        :param cache_dir: optional directory for a cache of the parsed data. If none of the input files have changed
+            the collection is loaded from the cache, otherwise the files are parsed and the cache is rewritten.
+            A collection loaded from the cache always has .store populated.
+        :param workers: number of worker processes used to parse the measurement worksheets and the fluorescence
+            baseline. None or 1 parses serially in this process.
+        :param lazy: if True spectra are materialized from the cache only when accessed, see LazySpectra.
+            Sample metadata, the store and the background are available without materializing any spectrum.
+            Requires cache_dir, on a cache miss the files are parsed and the written cache is loaded lazily.
+        :param max_resident: maximum number of materialized spectra kept in memory if lazy
+        :param stats: optional PipelineStats collecting stage timings and counters, kept as .stats
+        :param backend: reader backend of the measurement and baseline workbooks, 'openpyxl' (default) or 'ooxml',
+            see CQDReaders.open_reader(). Kept as .backend for refresh().
         :return: CQDCollection instance where .samples are populated
         """
         self = CQDCollection()
-        if not os.path.isdir(path):
-            raise NotADirectoryError(path + ' is not an existing directory')
+        if stats is not None:
+            self.stats = stats
+        self.backend = backend
+        input_paths = data_paths(path)
+        cqd2_path, map_path, flu_bg_path = input_paths
+        if lazy and cache_dir is None:
+            raise ValueError('Lazy loading of spectra requires a cache_dir')
+        if cache_dir is not None:
+            with self.stats.stage('load_cache'):
+                cached = CQDCache.load_collection(cache_dir, input_paths, lazy, max_resident)
+            if cached is not None:
+                cached.stats = self.stats
+                cached.backend = backend
+                self.stats.count('cache_hits')
+                return cached
 
         # .xls measurement data file not used anymore
         """
         cqd1_path = os.path.join(path, 'CQD_measurements1.xls')
         if not os.path.isfile(cqd1_path):
             raise FileNotFoundError(cqd1_path + ' does not exist')
-        self.cqd1_book = open_workbook(cqd1_path, on_demand=True)
+        self.cqd1_book = open_reader(cqd1_path, 'xlrd')
         """
 
-        # cqd2_path = os.path.join(path, 'CQD_measurements2.xlsx')
-        cqd2_path = os.path.join(path, 'CQD_measurements_abs adjusted_fluor adjusted.xlsx')
-        if not os.path.isfile(cqd2_path):
-            raise FileNotFoundError(cqd2_path + ' does not exist')
-        self.qcd2_book = load_workbook(cqd2_path)
-
-        # map_path = os.path.join(path, 'Well plate map.xlsx')
-        map_path = os.path.join(path, 'Well plate map_7oct24.xlsx')
-        if not os.path.isfile(map_path):
-            raise FileNotFoundError(map_path + ' does not exist')
-        self.parse_map_book(map_path)
+        with self.stats.stage('load_workbook'):
+            self.qcd2_book = open_reader(cqd2_path, backend)
+        with self.stats.stage('parse_map_book'):
+            map_entries = self.parse_map_book(map_path)
 
         # Plate index not used anymore
         """ 
@@ -61,55 +122,636 @@ class CQDCollection:
         self.parse_plate_index(plate_index_path)
         """
 
-        for sheet in self.qcd2_book.worksheets:
-            plate = ""
-            try:
-                plate = int(re.match('.*?([0-9]+)$', sheet.title).group(1))
-            except AttributeError:
-                raise ValueError('Invalid worksheet name: {}'.format(sheet.title))
-            self.parse_xlsx_sheet(sheet.title, plate)
+        sheets = [(sheet_name, sheet_plate(sheet_name)) for sheet_name in self.qcd2_book.sheet_names]
+
+        if workers is not None and workers > 1:
+            self.qcd2_book.close()
+            with self.stats.stage('parse_parallel'):
+                self.parse_parallel(cqd2_path, sheets, flu_bg_path, workers, backend)
+        else:
+            for sheet_name, plate in sheets:
+                with self.stats.stage('parse_xlsx_sheet', sheet_name):
+                    self.parse_xlsx_sheet(sheet_name, plate)
 
-        # cleanup to save memory
-        # self.cqd1_book.release_resources()
-        self.qcd2_book.close()
+            # cleanup to save memory
+            # self.cqd1_book.close()
+            self.qcd2_book.close()
 
-        flu_bg_path = os.path.join(path, 'Fluorescence baseline.xlsx')
-        if not os.path.isfile(flu_bg_path):
-            raise FileNotFoundError(flu_bg_path + ' does not exist')
-        self.parse_flu_bg_sheet(flu_bg_path)
+            with self.stats.stage('parse_flu_bg_sheet'):
+                self.parse_flu_bg_sheet(flu_bg_path)
 
-        # init abs background in CQDSpectrum
-        self.init_abs_background()
+        # init abs background of the collection
+        with self.stats.stage('init_abs_background'):
+            self.init_abs_background()
+        with self.stats.stage('fingerprints'):
+            self.fingerprints = input_fingerprints(cqd2_path, map_entries, flu_bg_path)
+
+        if columnar:
+            with self.stats.stage('build_store'):
+                self.build_store()
+
+        if cache_dir is not None:
+            try:
+                with self.stats.stage('save_cache'):
+                    CQDCache.save_collection(self, cache_dir, input_paths)
+            except ValueError as e:
+                print('Could not write cache: {}'.format(e))
+            else:
+                if lazy:
+                    cached = CQDCache.load_collection(cache_dir, input_paths, lazy, max_resident)
+                    cached.stats = self.stats
+                    cached.backend = backend
+                    return cached
 
         return self
 
+    @classmethod
+    def iter_plates(cls, path, two_pass=True, backend=None):
+        """
+        Stream the data of a directory plate by plate, see read_from_dir() for the files.
+        Each plate is yielded as a CQDCollection of the samples of the plate with spectra and background attached,
+        so the analysis functions can be used on it. Only one plate is parsed at a time, the workbook is read in
+        read-only mode and memory is bounded by one plate as long as the caller does not keep the plates.
+        Plates are yielded in worksheet order, plates of the map without worksheet last.
+        :param path: path to directory
+        :param two_pass: if True the absorbance background is computed from the blank samples in a first pass over
+            the worksheets, before any plate is yielded. If False only the fluorescence background is available.
+        :param backend: reader backend of the workbooks, see CQDReaders.open_reader()
+        :return: generator of CQDCollection instances, one per plate
+        """
+        cqd2_path, map_path, flu_bg_path = data_paths(path)
+        plate_entries = {}
+        for entry in read_map_book(map_path):
+            plate_entries.setdefault(entry[1], []).append(entry)
+        background = BackgroundModel().with_fluorescence(read_flu_bg_spectra(flu_bg_path, backend))
+
+        book = open_reader(cqd2_path, backend)
+        try:
+            plate_sheets = {}
+            for sheet_name in book.sheet_names:
+                plate_sheets.setdefault(sheet_plate(sheet_name), []).append(sheet_name)
+            if two_pass:
+                background = background.with_absorbance(*read_abs_background(book, plate_sheets, plate_entries))
+
+            for plate in list(plate_sheets) + [p for p in plate_entries if p not in plate_sheets]:
+                self = cls()
+                self.backend = backend
+                for entry in plate_entries.get(plate, []):
+                    self.add_sample(CQDSample(*entry))
+                self.qcd2_book = book
+                for sheet_name in plate_sheets.get(plate, []):
+                    self.parse_xlsx_sheet(sheet_name, plate)
+                self.qcd2_book = None
+                self.set_background(background)
+                yield self
+        finally:
+            book.close()
+
+    @classmethod
+    def iter_samples(cls, path, two_pass=True, backend=None):
+        """
+        Stream the samples of a directory with spectra and background attached, see iter_plates()
+        :param path: path to directory
+        :param two_pass: if True compute the absorbance background in a first pass, see iter_plates()
+        :param backend: reader backend of the workbooks, see CQDReaders.open_reader()
+        :return: generator of CQDSample
+        """
+        for plate in cls.iter_plates(path, two_pass, backend):
+            yield from plate.samples
+
+    def refresh(self, path):
+        """
+        Update the collection from changed input files without re-reading everything.
+        Worksheets of the measurement workbook and plate sections of the map file are compared with the fingerprints
+        of the last read. Samples of changed map sections are updated, added or removed, plates with changed
+        worksheets or new samples are re-parsed and their samples' .spectra dicts are patched in place.
+        Samples stay in map order, as read_from_dir() creates them.
+        The background is recomputed only if the blank samples or the fluorescence baseline file changed.
+        The store is rebuilt if it exists. A collection without fingerprints is re-parsed completely.
+        :param path: path to the data directory, see read_from_dir()
+        :return: RefreshReport(plates, added, removed, updated, background): set of re-parsed plates, lists of
+            added, removed and updated samples and True if the background was recomputed
+        """
+        cqd2_path, map_path, flu_bg_path = data_paths(path)
+        old = self.fingerprints or {'sheets': {}, 'map': {}, 'baseline': None}
+        map_entries = read_map_book(map_path)
+        new = input_fingerprints(cqd2_path, map_entries, flu_bg_path)
+        blanks = list(self.comment_index.get('blank', []))
+
+        # Map: match samples of changed plates by position, in map order for duplicated positions
+        changed_plates = {p for p in set(old['map']) | set(new['map']) if old['map'].get(p) != new['map'].get(p)}
+        entries_at = {}
+        for entry in map_entries:
+            if str(entry[1]) in changed_plates:
+                entries_at.setdefault((entry[1], entry[2]), []).append(entry)
+        added, removed, updated = [], [], []
+        samples_at = {pos: list(samples) for pos, samples in self.well_index.items()}
+        positions = list(entries_at) + [pos for pos in self.well_index
+                                        if str(pos[0]) in changed_plates and pos not in entries_at]
+        for pos in positions:
+            current = self.well_index.get(pos, [])
+            entries = entries_at.get(pos, [])
+            for sample, entry in zip(current, entries):
+                meta = (entry[0],) + entry[3:]
+                if (sample.label, sample.klass, sample.comment, sample.reactants) != meta:
+                    sample.label, sample.klass, sample.comment, sample.reactants = meta
+                    updated.append(sample)
+            removed.extend(current[len(entries):])
+            new_samples = [CQDSample(*entry) for entry in entries[len(current):]]
+            added.extend(new_samples)
+            samples_at[pos] = current[:len(entries)] + new_samples
+        # Samples in map order like read_from_dir(), reusing the sample objects. Samples not in the map are kept last.
+        samples = [samples_at[(entry[1], entry[2])].pop(0) for entry in map_entries]
+        self.samples = samples + [s for pos_samples in samples_at.values() for s in pos_samples]
+        self.rebuild_index()
+
+        # Measurements: plates of changed or removed worksheets and plates with new samples are parsed again
+        sheets = {name: sheet_plate(name) for name in new['sheets']}
+        plates = {sheet_plate(name) for name in set(old['sheets']) | set(new['sheets'])
+                  if old['sheets'].get(name) != new['sheets'].get(name)}
+        plates.update(s.plate for s in added)
+        if plates:
+            for sample in self.samples:
+                if sample.plate in plates:
+                    sample.spectra.clear()
+            self.qcd2_book = open_reader(cqd2_path, self.backend)
+            for sheet_name, plate in sheets.items():
+                if plate in plates:
+                    self.parse_xlsx_sheet(sheet_name, plate)
+            self.qcd2_book.close()
+
+        # Background: fluorescence from the baseline file, absorbance from the blank samples
+        background = self.background
+        flu_changed = old['baseline'] != new['baseline']
+        if flu_changed:
+            background = BackgroundModel(background.abs_x, background.abs_y).with_fluorescence(
+                read_flu_bg_spectra(flu_bg_path, self.backend))
+        new_blanks = self.comment_index.get('blank', [])
+        abs_changed = ([id(s) for s in blanks] != [id(s) for s in new_blanks]
+                       or any(s.plate in plates for s in new_blanks))
+        if plates or flu_changed:
+            self.set_background(background)
+        if abs_changed:
+            self.init_abs_background()
+
+        if self.store is not None and (plates or removed):
+            self.build_store()
+        self.fingerprints = new
+        return RefreshReport(plates, added, removed, updated, flu_changed or abs_changed)
+
+    def build_store(self, spec_types=None, grids=None):
+        """
+        Pack all spectra into a CQDSpectralStore, one contiguous array per spectrum type with a shared wavelength axis.
+        The CQDSpectrum objects of the samples on the shared grid become views into the store, spectra measured at
+        other wavelengths are resampled into the store and keep their own arrays.
+        :param spec_types: spectrum types to pack, default all
+        :param grids: optional dict{spec_type: wavelengths} of the shared grids, see CQDSpectralStore.from_samples()
+        :return: the CQDSpectralStore, also available as self.store
+        """
+        self.store = CQDSpectralStore.from_samples(self.samples, spec_types, grids)
+        self.store.attach()
+        return self.store
+
+    def subtract_all(self, spec_types=None):
+        """
+        Background subtraction of all spectra in the collection with a few array operations per spectrum type.
+        The fluorescence background is interpolated once per distinct (ex_wl, gain).
+        Spectra with a gain outside the range of the background spectra are returned unsubtracted and reported
+        together in one message.
+        :param spec_types: optional spectrum types to subtract, e.g. ['ex350'], default all. The absorbance
+            background is only needed if 'abs' is subtracted.
+        :return: dict{spec_type: Numpy.array} of shape (channels, samples, wavelengths). Rows are aligned with
+            self.store[spec_type].samples, channels with self.store[spec_type].channels. Builds the store if needed.
+        """
+        if self.store is None:
+            self.build_store()
+
+        subbed = {}
+        out_of_range = {}  # (spec_type, gain) -> number of spectra
+        for spec_type, table in self.store.tables.items():
+            if spec_types is not None and spec_type not in spec_types:
+                continue
+            if 'gain' not in table.meta_data[0]:
+                # Absorbance spectra
+                if self.background.abs_x is None:
+                    raise ValueError('Background spectrum is not initialized')
+                subbed[spec_type] = table.data - self.background.absorbance_background(table.wl_vector)
+                continue
+
+            ex_wls = np.array([m['ex_wl'] for m in table.meta_data], dtype=float)
+            keys, inverse = np.unique(np.stack([ex_wls, table.gains], axis=1), axis=0, return_inverse=True)
+            bg = np.zeros((len(keys),) + table.data[:, 0].shape)
+            for i, (ex_wl, gain) in enumerate(keys):
+                bg_ys = self.background.fluorescence_background(int(ex_wl), _as_number(gain), table.wl_vector)
+                if bg_ys is None:
+                    out_of_range[(spec_type, _as_number(gain))] = np.count_nonzero(inverse.ravel() == i)
+                    continue
+                bg[i] = [bg_ys[k] for k in table.channels]
+            subbed[spec_type] = table.data - bg[inverse.ravel()].transpose(1, 0, 2)
+
+        if out_of_range:
+            print('{} spectra with gain out of range for subtraction, returning original spectra: {}'.format(
+                sum(out_of_range.values()),
+                ', '.join('{} gain={} ({})'.format(t, g, n) for (t, g), n in out_of_range.items())))
+        return subbed
+
+    def qc_report(self, spec_types=spectrum_types, saturated_only=False):
+        """
+        Quality control of all spectra: missing spectra and saturated ('OVER') points, see SpectrumTable.over.
+        Points that are nan because a row was cut short or lies outside the measured wavelengths do not count.
+        Spectra resampled into the store are counted on the wavelengths they were measured at.
+        Computed with array operations on the columnar store, which is built if needed.
+        :param spec_types: spectrum types every sample should have
+        :param saturated_only: if True only channels with saturated points are included in .saturation
+        :return: QCReport(missing, saturation) of numpy structured arrays sorted by plate and well.
+            missing: one row per missing spectrum with fields label, plate, well, klass, spec_type.
+            saturation: one row per spectrum and channel with fields label, plate, well, klass, spec_type, channel,
+            n_over, first_wl and last_wl (nan if no saturated points).
+        """
+        if self.store is None:
+            self.build_store()
+
+        fields = _sample_fields(self.samples)
+        positions = {id(s): i for i, s in enumerate(self.samples)}
+
+        present = np.zeros((len(self.samples), len(spec_types)), dtype=bool)
+        sat_parts = []
+        for t, spec_type in enumerate(spec_types):
+            if spec_type not in self.store:
+                continue
+            table = self.store[spec_type]
+            rows = np.array([positions[id(s)] for s in table.samples], dtype=int)
+            present[rows, t] = True
+
+            n_over, first, last = _saturation(table.wl_vector, table.over)  # each (channels, samples)
+            for i in np.flatnonzero(table.resampled):
+                spectrum = table.samples[i].spectra[spec_type]
+                for c, key in enumerate(table.channels):
+                    over = spectrum.over_mask(key)
+                    n_over[c, i], first[c, i], last[c, i] = _saturation(spectrum.wl_vector[:len(over)], over)
+            sat_parts.append({'sample': np.tile(rows, len(table.channels)),
+                              'spec_type': np.full(n_over.size, spec_type),
+                              'channel': np.repeat(np.array(table.channels, dtype=str), len(rows)),
+                              'n_over': n_over.ravel(), 'first_wl': first.ravel(), 'last_wl': last.ravel()})
+
+        missing_rows, missing_types = np.nonzero(~present)
+        missing = _to_records({**{k: v[missing_rows] for k, v in fields.items()},
+                               'spec_type': np.array(spec_types, dtype=str)[missing_types]})
+
+        sat = _concat_columns(sat_parts, {'sample': int, 'spec_type': str, 'channel': str, 'n_over': int,
+                                          'first_wl': float, 'last_wl': float})
+        if saturated_only:
+            sat = {k: v[sat['n_over'] > 0] for k, v in sat.items()}
+        rows = sat.pop('sample')
+        saturation = _to_records({**{k: v[rows] for k, v in fields.items()}, **sat})
+
+        # Stable sort keeps spectrum type and channel order within a well
+        missing = missing[np.lexsort((missing['well'], missing['plate']))]
+        saturation = saturation[np.lexsort((saturation['well'], saturation['plate']))]
+        return QCReport(missing, saturation)
+
+    def fit_peaks(self, spec_types=('ex350', 'ex400'), channels=None, model='gaussian', subtract=True, workers=None,
+                  **fit_args):
+        """
+        Fits a peak model to every trace of the given spectrum types in one batch per spectrum type,
+        see CQDPeaks.fit_peaks(). Uses the columnar store, which is built if needed.
+        :param spec_types: spectrum types to fit, 'abs', 'ex350' and/or 'ex400'
+        :param channels: optional list of y_vectors keys to fit, e.g. ['Aq', 'Cu'], default all
+        :param model: 'gaussian' or 'lorentzian'
+        :param subtract: if True fit background subtracted spectra, see subtract_all()
+        :param workers: number of worker processes used for the fits
+        :param fit_args: further arguments to CQDPeaks.fit_peaks()
+        :return: numpy structured array with fields label, plate, well, klass, spec_type, channel, center, fwhm,
+            height, area, offset, rmse and converged, one row per trace
+        """
+        if self.store is None:
+            self.build_store()
+        data = self.subtract_all(spec_types) if subtract else {k: t.data for k, t in self.store.tables.items()}
+
+        parts = []
+        for spec_type in spec_types:
+            if spec_type not in self.store:
+                continue
+            table = self.store[spec_type]
+            sel = [c for c, k in enumerate(table.channels) if channels is None or k in channels]
+            if not sel or not len(table):
+                continue
+            ys = data[spec_type][sel].reshape(-1, len(table.wl_vector))
+            over = table.over[sel].reshape(ys.shape)
+            fits = CQDPeaks.fit_peaks(table.wl_vector, ys, model=model, workers=workers, over=over, **fit_args)
+            part = {k: np.tile(v, len(sel)) for k, v in _sample_fields(table.samples).items()}
+            part['spec_type'] = np.full(len(ys), spec_type)
+            part['channel'] = np.repeat(np.array([table.channels[c] for c in sel], dtype=str), len(table))
+            part.update({k: fits[k] for k in fits.dtype.names})
+            parts.append(part)
+
+        dtypes = {'label': str, 'plate': int, 'well': int, 'klass': str, 'spec_type': str, 'channel': str}
+        dtypes.update(CQDPeaks.peak_dtype)
+        return _to_records(_concat_columns(parts, dtypes))
+
+    def quench_scores(self, spec_types=('ex350', 'ex400'), metals=CQDQuench.metal_channels, subtract=True):
+        """
+        Metal quenching scores of every sample relative to the Aq reference, see CQDQuench.quench_scores().
+        Computed with array operations on the columnar store, which is built if needed.
+        :param spec_types: fluorescence spectrum types to score
+        :param metals: metal channels to score
+        :param subtract: if True score background subtracted spectra, see subtract_all()
+        :return: numpy structured array with fields label, plate, well, klass, reactant1, reactant2, spec_type,
+            ref_area, ref_peak_wl and <metal>_area_ratio, <metal>_peak_ratio, <metal>_shift for each metal.
+            One row per sample and spectrum type, missing reactants are ''.
+        """
+        if self.store is None:
+            self.build_store()
+        data = self.subtract_all(spec_types) if subtract else {k: t.data for k, t in self.store.tables.items()}
+
+        parts = []
+        for spec_type in spec_types:
+            if spec_type not in self.store or not len(self.store[spec_type]):
+                continue
+            table = self.store[spec_type]
+            part = _sample_fields(table.samples)
+            part.update(_reactant_fields(table.samples))
+            part['spec_type'] = np.full(len(table), spec_type)
+            part.update(CQDQuench.quench_scores(table.wl_vector, data[spec_type], table.channels, metals=metals))
+            parts.append(part)
+
+        dtypes = {'label': str, 'plate': int, 'well': int, 'klass': str, 'reactant1': str, 'reactant2': str,
+                  'spec_type': str, 'ref_area': float, 'ref_peak_wl': float}
+        dtypes.update({'{}_{}'.format(m, f): float for m in metals for f in CQDQuench.metal_fields})
+        return _to_records(_concat_columns(parts, dtypes))
+
+    def quench_summary(self, by='klass', scores=None):
+        """
+        Mean and standard deviation of the quench scores per group and spectrum type
+        :param by: 'klass' or 'reactant'. Samples made with two reactants count in the group of each reactant.
+        :param scores: optional result of quench_scores(), computed if not given
+        :return: numpy structured array sorted by spectrum type and group with fields spec_type, <by>, n_samples
+            and <field>_mean, <field>_std for each score field. nan scores are left out of mean and std.
+        """
+        if scores is None:
+            scores = self.quench_scores()
+        if by == 'klass':
+            rows = np.arange(len(scores))
+            keys = scores['klass']
+        elif by == 'reactant':
+            rows = np.concatenate([np.flatnonzero(scores[f] != '') for f in ('reactant1', 'reactant2')])
+            keys = np.concatenate([scores[f][scores[f] != ''] for f in ('reactant1', 'reactant2')])
+        else:
+            raise ValueError("Unknown quench summary grouping {}, expected 'klass' or 'reactant'".format(by))
+
+        score_fields = [f for f in scores.dtype.names if scores.dtype[f].kind == 'f']
+        groups, n_rows, stats = CQDQuench.aggregate(_to_records({'spec_type': scores['spec_type'][rows], by: keys}),
+                                                    {f: scores[f][rows] for f in score_fields})
+        summary = {'spec_type': groups['spec_type'], by: groups[by], 'n_samples': n_rows}
+        for f in score_fields:
+            _, summary[f + '_mean'], summary[f + '_std'] = stats[f]
+        return _to_records(summary)
+
+    def quench_ranking(self, field='Cu_area_ratio', n=10, spec_type='ex350', largest=False, scores=None):
+        """
+        Top-N samples by a quench score
+        :param field: score field of quench_scores() to rank by
+        :param n: number of samples to return
+        :param spec_type: spectrum type to rank, None ranks the rows of all spectrum types together
+        :param largest: if False the lowest values (strongest quenching for ratios) come first
+        :param scores: optional result of quench_scores(), computed if not given
+        :return: rows of scores in rank order, samples with a nan score are not ranked
+        """
+        if scores is None:
+            scores = self.quench_scores()
+        if spec_type is not None:
+            scores = scores[scores['spec_type'] == spec_type]
+        return scores[CQDQuench.top_n(scores[field], n, largest)]
+
+    def spectral_index(self, spec_type='ex350', channels=None, metric='correlation', subtract=True, wl_grid=None):
+        """
+        Similarity index over the spectra of one spectrum type, see SpectralIndex.
+        Built from the columnar store, which is built if needed. More samples or plates can be added later.
+        :param spec_type: spectrum type to index
+        :param channels: channels making up the vector of a spectrum, default all channels of the spectrum type
+        :param metric: 'cosine' or 'correlation'
+        :param subtract: if True index background subtracted spectra, see subtract_all()
+        :param wl_grid: wavelength grid of the index, default the wavelengths of the store
+        :return: SpectralIndex instance
+        """
+        if self.store is None:
+            self.build_store()
+        if spec_type not in self.store:
+            raise ValueError('No {} spectra in the collection'.format(spec_type))
+        table = self.store[spec_type]
+        index = SpectralIndex(spec_type, table.wl_vector if wl_grid is None else wl_grid,
+                              table.channels if channels is None else channels, metric, capacity=len(table))
+        index.add_collection(self, subtract)
+        return index
+
+    def export_long(self, path, spec_types=spectrum_types, subtract=False, chunk_rows=CQDExport.chunk_rows):
+        """
+        Export all spectra in long format, one row per spectrum point with fields label, plate, well, klass,
+        spec_type, channel, wl, value and saturated. Saturated ('OVER') points have value nan and saturated True,
+        points of rows cut short or outside the measured wavelengths have value nan and saturated False.
+        Rows are streamed from the columnar store, which is built if needed, in chunks of whole samples.
+        :param path: path of the output file, '.csv' or '.npy' (numpy structured array, written through a memory map)
+        :param spec_types: spectrum types to export
+        :param subtract: if True export background subtracted values, see subtract_all()
+        :param chunk_rows: maximum number of rows converted at a time
+        :return: number of rows written
+        """
+        if self.store is None:
+            self.build_store()
+        tables = [self.store[t] for t in spec_types if t in self.store]
+        data = self.subtract_all(spec_types) if subtract else {t.spec_type: t.data for t in tables}
+        dtype = CQDExport.long_dtype(tables)
+        chunks = CQDExport.iter_long(tables, data, dtype, chunk_rows)
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.csv':
+            return CQDExport.write_csv(path, CQDExport.long_fields, chunks)
+        elif ext == '.npy':
+            n_rows = sum(t.data.size for t in tables)
+            return CQDExport.write_npy(path, dtype, n_rows, chunks)
+        raise ValueError('Unknown export format {}, expected .csv or .npy'.format(ext))
+
+    def export_wide(self, out_dir, fmt='npy', spec_types=spectrum_types, subtract=False,
+                    chunk_rows=CQDExport.chunk_rows):
+        """
+        Export all spectra in wide format, one file per spectrum type with one row per sample and channel.
+        '<spec_type>.csv' has the columns label, plate, well, klass, channel and one column per wavelength.
+        '<spec_type>.npy' is a numpy structured array with fields label, plate, well, klass, channel and values,
+        the wavelengths are written to '<spec_type>_wl.npy'.
+        Rows are streamed from the columnar store, which is built if needed, in chunks of whole samples.
+        :param out_dir: directory to write the files to, created if missing
+        :param fmt: 'csv' or 'npy'
+        :param spec_types: spectrum types to export
+        :param subtract: if True export background subtracted values, see subtract_all()
+        :param chunk_rows: maximum number of rows converted at a time
+        :return: list of paths of written files
+        """
+        if fmt not in ('csv', 'npy'):
+            raise ValueError("Unknown export format {}, expected 'csv' or 'npy'".format(fmt))
+        if self.store is None:
+            self.build_store()
+        tables = [self.store[t] for t in spec_types if t in self.store]
+        data = self.subtract_all(spec_types) if subtract else {t.spec_type: t.data for t in tables}
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for table in tables:
+            dtype = CQDExport.wide_dtype(table)
+            chunks = CQDExport.iter_wide(table, data[table.spec_type], dtype, chunk_rows)
+            path = os.path.join(out_dir, '{}.{}'.format(table.spec_type, fmt))
+            if fmt == 'csv':
+                header = list(CQDExport.wide_fields) + ['{:g}'.format(wl) for wl in table.wl_vector]
+                CQDExport.write_csv(path, header, chunks)
+            else:
+                wl_path = os.path.join(out_dir, '{}_wl.npy'.format(table.spec_type))
+                np.save(wl_path, table.wl_vector)
+                CQDExport.write_npy(path, dtype, len(table) * len(table.channels), chunks)
+                paths.append(wl_path)
+            paths.append(path)
+        return paths
+
+    def write_reports(self, out_dir, workers=None):
+        """
+        Write one formatted .xlsx workbook per klass, '<klass>.xlsx', with one worksheet per sample.
+        Workbooks are written in write-only mode.
+        :param out_dir: directory to write the workbooks to, created if missing
+        :param workers: number of worker processes writing workbooks in parallel. None or 1 writes serially.
+        :return: list of paths of written workbooks
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        jobs = [(os.path.join(out_dir, '{}.xlsx'.format(klass)), samples)
+                for klass, samples in self.klass_index.items()]
+        self.stats.count('sheets_written', len(self.samples))
+        with self.stats.stage('write_reports'):
+            if workers is not None and workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    return list(pool.map(write_workbook, *zip(*jobs)))
+            paths = []
+            for (path, samples), klass in zip(jobs, self.klass_index):
+                with self.stats.stage('write_workbook', klass):
+                    paths.append(write_workbook(path, samples))
+            return paths
+
     def parse_map_book(self, map_path):
         """
         Parses the 'Well plate map.xls' file and creates sample instances with corresponding metadata
         :param map_path: path to the map file
+        :return: list of sample entries, see read_map_book()
+        """
+        entries = read_map_book(map_path)
+        for entry in entries:
+            self.add_sample(CQDSample(*entry))
+        return entries
+
+    def add_sample(self, sample):
+        """
+        Add a sample to the collection and to the lookup indexes
+        :param sample: CQDSample instance
+        """
+        self.samples.append(sample)
+        self._index_sample(sample, len(self.samples) - 1)
+
+    def rebuild_index(self):
+        """
+        Rebuild the lookup indexes from self.samples. Needed if self.samples or the metadata of a sample has been
+        modified directly.
+        """
+        self.well_index = {}
+        self.label_index = {}
+        self.klass_index = {}
+        self.plate_index = {}
+        self.reactant_index = {}
+        self.comment_index = {}
+        self.position_index = {}
+        for position, sample in enumerate(self.samples):
+            self._index_sample(sample, position)
+
+    def _index_sample(self, sample, position):
+        self.well_index.setdefault((sample.plate, sample.well), []).append(sample)
+        self.label_index.setdefault(sample.label, []).append(sample)
+        self.klass_index.setdefault(sample.klass, []).append(sample)
+        self.plate_index.setdefault(sample.plate, []).append(sample)
+        for reactant in dict.fromkeys(sample.reactants):
+            self.reactant_index.setdefault(reactant, []).append(sample)
+        self.comment_index.setdefault(comment_category(sample.comment), []).append(sample)
+        self.position_index[id(sample)] = position
+
+    def query(self, klass=None, reactant=None, comment=None, plate=None, spectra=None):
+        """
+        Samples matching all given filters, e.g. all samples made with Urea in KLASS1 that have all spectra:
+            collection.query(klass='KLASS1', reactant='Urea', spectra=spectrum_types)
+        A filter given as a list matches any of its values. Candidates are taken from the index of the filter
+        matching the fewest samples and checked against the other filters, so the cost is proportional to that
+        index and not to the collection.
+        :param klass: klass or list of klasses
+        :param reactant: reactant or list of reactants the sample was made with
+        :param comment: comment category or list of categories, see comment_category()
+        :param plate: plate index or list of plate indexes
+        :param spectra: list of spectrum types the sample must all have
+        :return: list of samples in collection order
+        """
+        return [self.samples[i] for i in self.query_indexes(klass, reactant, comment, plate, spectra)]
+
+    def query_indexes(self, klass=None, reactant=None, comment=None, plate=None, spectra=None):
+        """
+        Indexes into self.samples of the samples matching all given filters, see query()
+        :return: sorted numpy array of int
+        """
+        filters = {name: set(v) if isinstance(v, (list, tuple, set, frozenset)) else {v}
+                   for name, v in (('klass', klass), ('reactant', reactant), ('comment', comment), ('plate', plate))
+                   if v is not None}
+        indexes = {'klass': self.klass_index, 'reactant': self.reactant_index, 'comment': self.comment_index,
+                   'plate': self.plate_index}
+        first = None
+        candidates = self.samples
+        if filters:
+            first = min(filters, key=lambda n: sum(len(indexes[n].get(v, ())) for v in filters[n]))
+            # Samples made with several of the reactants are in several lists
+            candidates = {id(s): s for v in filters[first] for s in indexes[first].get(v, ())}.values()
+        rows = [self.position_index[id(s)] for s in candidates
+                if all(not values.isdisjoint(_filter_keys[name](s)) for name, values in filters.items()
+                       if name != first)
+                and (spectra is None or all(t in s.spectra for t in spectra))]
+        return np.array(sorted(rows), dtype=int)
+
+    def samples_at(self, plate, well):
+        """
+        Look up samples by position. A valid map has exactly one sample per position.
+        :param plate: plate index
+        :param well: well index
+        :return: list of samples at (plate, well)
+        """
+        return list(self.well_index.get((plate, well), []))
+
+    def samples_with_label(self, label):
+        """
+        Look up samples by label
+        :param label: sample label string
+        :return: list of samples with the label
+        """
+        return list(self.label_index.get(label, []))
+
+    def samples_in_klass(self, klass):
+        """
+        Look up samples by school class
+        :param klass: klass string, upper case as in CQDSample.klass
+        :return: list of samples produced by the klass
+        """
+        return list(self.klass_index.get(klass, []))
+
+    def samples_on_plate(self, plate):
         """
-        map_book = load_workbook(map_path)
-        ms = map_book.active
-        plate = None
-        well_mod = None
-        for row in ms.iter_rows(min_row=1, max_col=7, values_only=True):
-            if row[0] == 'Plate':
-                plate = row[1]  # New plate
-            if row[0] == 'A':
-                well_mod = 0  # First row of plate
-            if row[0] == 'E':
-                well_mod = 12  # Second row of plate
-
-            reactants = []
-            if row[3] is not None:
-                reactants.append(row[3])
-            if row[4] is not None:
-                reactants.append(row[4])
-
-            if row[2] is not None:
-                klass = row[5].strip().upper()
-                self.samples.append(CQDSample(str(row[2]), plate, well_mod + row[1], klass, row[6], reactants))
-        map_book.close()
+        Look up samples by plate
+        :param plate: plate index
+        :return: list of samples on the plate
+        """
+        return list(self.plate_index.get(plate, []))
+
+    def samples_with_reactant(self, reactant):
+        """
+        Look up samples by reactant
+        :param reactant: reactant as in the map file
+        :return: list of samples made with the reactant
+        """
+        return list(self.reactant_index.get(reactant, []))
 
     def parse_plate_index(self, plate_index_path):
         """
@@ -148,32 +790,17 @@ class CQDCollection:
         :return:
         """
         try:
-            ws = self.cqd1_book.sheet_by_name(sheet_name)
-        except XLRDError:
+            sheet_rows = self.cqd1_book.iter_rows(sheet_name)
+        except KeyError:
             print('Could not find sheet {} in QCD1 workbook'.format(sheet_name))
             return
-        fc = ws.col(0)
-        for i in (x for x in fc if x.value.startswith('Label: ')):
-            l_row = fc.index(i)
-            st_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Start Time:')))
-            et_row = fc.index(next((x for x in fc[l_row:] if x.value == 'End Time:')))
-            wl_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Wavel.')))
-
-            rows = []
-            while fc[wl_row].ctype != 0:
-                rows.append(ws.row_values(wl_row))
-                wl_row += 1
-
-            spectrum = CQDSpectrum.spectrum_from_xl_data(ws.cell(st_row, 1).value, ws.cell(et_row, 1).value,
-                                                         ws.col_values(0, l_row + 1, st_row),
-                                                         ws.col_values(4, l_row + 1, st_row),
-                                                         rows)
-            well, spec_type = parse_spectrometer_label(i.value)
-            samples = list(s for s in self.samples if s.plate == plate and s.well == well)
+        for label, start_t, end_t, attrib_col, value_col, rows in iter_spectrum_blocks(sheet_rows):
+            spectrum = CQDSpectrum.spectrum_from_xl_data(start_t, end_t, attrib_col, value_col, rows)
+            well, spec_type = parse_spectrometer_label(label)
+            samples = self.well_index.get((plate, well), [])
             if len(samples) != 1:
                 raise ValueError('plate={}, well={} finds {} samples. Not exactly 1!'.format(plate, well, len(samples)))
             samples[0].spectra[spec_type] = spectrum
-            self.cqd1_book.unload_sheet(sheet_name)  # close sheet to save memory
 
     def parse_xlsx_sheet(self, sheet_name, plate):
         """
@@ -183,116 +810,301 @@ class CQDCollection:
         :return:
         """
         try:
-            ws = self.qcd2_book[sheet_name]
+            sheet_rows = self.qcd2_book.iter_rows(sheet_name)
         except KeyError:
             print('Could not find sheet {} in QCD2 workbook'.format(sheet_name))
             return
-        fc = ws['A']
-        for i in (x for x in fc if x.value is not None and x.value.startswith('Label: ')):
-
-            well, spec_type = parse_spectrometer_label(i.value)
-            samples = list(s for s in self.samples if s.plate == plate and s.well == well)
-            if len(samples) == 0:
-                print('plate={}, well={} no sample initialized. Discarding data!'.format(plate, well))
+        sheet_rows = self.stats.counted(sheet_rows, 'rows_read')
+        for label, start_t, end_t, attrib_col, value_col, rows in iter_spectrum_blocks(sheet_rows):
+            sample, spec_type = self._block_sample(plate, label)
+            if sample is None:
                 continue
-            elif len(samples) > 1:
-                raise ValueError('plate={}, well={} finds {} samples. More than 1!'.format(plate, well, len(samples)))
+            spectrum = CQDSpectrum.spectrum_from_xl_data(start_t, end_t, attrib_col, value_col, rows)
+            self._count_spectrum(spectrum)
+            sample.spectra[spec_type] = spectrum
 
-            l_row = fc.index(i)
-            st_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Start Time:')))
-            et_row = fc.index(next((x for x in fc[l_row:] if x.value == 'End Time:')))
-            wl_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Wavel.')))
+    def parse_parallel(self, cqd2_path, sheets, flu_bg_path, workers, backend=None):
+        """
+        Parses measurement worksheets and the fluorescence baseline file in worker processes.
+        Spectra are attached to the samples in sheet and block order, giving the same result as parsing serially.
+        The parse time and row count of each sheet, measured in the worker, are recorded in .stats as
+        'parse_xlsx_sheet:<sheet>' and 'rows_read' like in a serial parse.
+        :param cqd2_path: path to the measurement workbook
+        :param sheets: list of (sheet_name, plate) tuples
+        :param flu_bg_path: path to the fluorescence baseline file
+        :param workers: number of worker processes
+        :param backend: reader backend, see CQDReaders.open_reader()
+        """
+        plate_wells = {}
+        for plate, well in self.well_index:
+            plate_wells.setdefault(plate, set()).add(well)
 
-            rows = []
-            while fc[wl_row].value is not None:
-                r = list(ws.iter_rows(min_row=wl_row + 1, max_row=wl_row + 1, values_only=True))[0]
-                try:
-                    end_i = r.index(None)
-                    rows.append(list(r[:end_i]))
-                except ValueError:
-                    rows.append(list(r))
-                wl_row += 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            bg_future = pool.submit(read_flu_bg_spectra, flu_bg_path, backend)
+            futures = [pool.submit(read_xlsx_sheet_spectra, cqd2_path, sheet_name, plate_wells.get(plate, set()),
+                                   backend, self.stats.enabled) for sheet_name, plate in sheets]
+            for (sheet_name, plate), future in zip(sheets, futures):
+                spectra, seconds, rows_read = future.result()
+                if spectra is None:
+                    print('Could not find sheet {} in QCD2 workbook'.format(sheet_name))
+                    continue
+                self.stats.record('parse_xlsx_sheet', seconds, sheet_name)
+                self.stats.count('rows_read', rows_read)
+                for label, spectrum in spectra:
+                    sample, spec_type = self._block_sample(plate, label)
+                    if sample is not None:
+                        self._count_spectrum(spectrum)
+                        sample.spectra[spec_type] = spectrum
+            self.set_background(self.background.with_fluorescence(bg_future.result()))
 
-            attr_col = list(ws.iter_cols(min_row=l_row + 2, max_row=st_row, min_col=1, max_col=1, values_only=True))
-            val_col = list(ws.iter_cols(min_row=l_row + 2, max_row=st_row, min_col=5, max_col=5, values_only=True))
+    def _block_sample(self, plate, label):
+        """
+        Find the sample a spectrometer data block belongs to
+        :param plate: plate index of the worksheet
+        :param label: 'Label: ' string of the block
+        :return: (sample, spec_type), sample is None if no sample is initialized for the well
+        """
+        well, spec_type = parse_spectrometer_label(label)
+        samples = self.well_index.get((plate, well), [])
+        if len(samples) == 0:
+            print('plate={}, well={} no sample initialized. Discarding data!'.format(plate, well))
+            self.stats.count('blocks_discarded')
+            return None, spec_type
+        elif len(samples) > 1:
+            raise ValueError('plate={}, well={} finds {} samples. More than 1!'.format(plate, well, len(samples)))
+        return samples[0], spec_type
 
-            spectrum = CQDSpectrum.spectrum_from_xl_data(ws.cell(st_row + 1, 2).value, ws.cell(et_row + 1, 2).value,
-                                                         list(attr_col[0]), list(val_col[0]), rows)
-            samples[0].spectra[spec_type] = spectrum
+    def _count_spectrum(self, spectrum):
+        # Spectrum counters
+        if not self.stats.enabled:
+            return
+        self.stats.count('spectra_parsed')
+        if spectrum is not None:
+            self.stats.count('over_cells', sum(int(np.count_nonzero(spectrum.over_mask(k)))
+                                               for k in spectrum.y_vectors))
 
     def parse_flu_bg_sheet(self, flu_bg_path):
-        wb = load_workbook(flu_bg_path)
-        ws = wb.active
-        fc = ws['A']
-        for i in (x for x in fc if x.value is not None and x.value.startswith('Label: ')):
-            l_row = fc.index(i)
-            st_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Start Time:')))
-            et_row = fc.index(next((x for x in fc[l_row:] if x.value == 'End Time:')))
-            wl_row = fc.index(next((x for x in fc[l_row:] if x.value == 'Wavel.')))
-
-            rows = []
-            while fc[wl_row].value is not None:
-                r = list(ws.iter_rows(min_row=wl_row + 1, max_row=wl_row + 1, values_only=True))[0]
-                try:
-                    end_i = r.index(None)
-                    rows.append(list(r[:end_i]))
-                except ValueError:
-                    rows.append(list(r))
-                wl_row += 1
-
-            attr_col = list(ws.iter_cols(min_row=l_row + 2, max_row=st_row, min_col=1, max_col=1, values_only=True))
-            val_col = list(ws.iter_cols(min_row=l_row + 2, max_row=st_row, min_col=5, max_col=5, values_only=True))
-
-            spectrum = CQDSpectrum.spectrum_from_xl_data(ws.cell(st_row + 1, 2).value, ws.cell(et_row + 1, 2).value,
-                                                         list(attr_col[0]), list(val_col[0]),
-                                                         rows)
-            if spectrum.meta_data['ex_wl'] == 350:
-                if CQDSpectrum.bg_ex350_x is None:
-                    CQDSpectrum.bg_ex350_x = spectrum.wl_vector
-                elif not np.array_equal(CQDSpectrum.bg_ex350_x, spectrum.wl_vector):
-                    raise ValueError("Trying to initialize fluorescence background with invalid wavelength vector")
-                CQDSpectrum.bg_ex350_ys[spectrum.meta_data['gain']] = spectrum.y_vectors
-            elif spectrum.meta_data['ex_wl'] == 400:
-                if CQDSpectrum.bg_ex400_x is None:
-                    CQDSpectrum.bg_ex400_x = spectrum.wl_vector
-                elif not np.array_equal(CQDSpectrum.bg_ex400_x, spectrum.wl_vector):
-                    raise ValueError("Trying to initialize fluorescence background with invalid wavelength vector")
-                CQDSpectrum.bg_ex400_ys[spectrum.meta_data['gain']] = spectrum.y_vectors
-            else:
-                raise ValueError('Spectrum with invalid wavelength {} in "Fluorescence baseline.xlsx" file'.
-                                 format(spectrum.meta_data['ex_wl']))
-        wb.close()
+        """
+        Parses the 'Fluorescence baseline.xlsx' file and adds it to the fluorescence background of the collection
+        :param flu_bg_path: path to the fluorescence baseline file
+        """
+        self.set_background(self.background.with_fluorescence(read_flu_bg_spectra(flu_bg_path, self.backend)))
+
+    def set_background(self, background):
+        """
+        Set the BackgroundModel of the collection and of all its spectra.
+        Interpolated fluorescence backgrounds are precomputed for the gains of the spectra.
+        Lazily loaded spectra are not materialized, they get the background when they are.
+        :param background: BackgroundModel
+        """
+        if self.spectrum_loader is None:
+            spectra = [s for samp in self.samples for s in samp.spectra.values() if s is not None]
+            meta_data = [s.meta_data for s in spectra]
+        else:
+            spectra = [s for samp in self.samples if isinstance(samp.spectra, LazySpectra)
+                       for s in samp.spectra.loaded() if s is not None]
+            spectra += [s for samp in self.samples if not isinstance(samp.spectra, LazySpectra)
+                        for s in samp.spectra.values() if s is not None]
+            meta_data = [s.meta_data for s in spectra] + [m for t in self.spectrum_loader.store.tables.values()
+                                                          for m in t.meta_data]
+        background = background.with_gains({(m['ex_wl'], m['gain']) for m in meta_data if 'gain' in m})
+        self.background = background
+        for spectrum in spectra:
+            spectrum.background = background
+        if self.spectrum_loader is not None:
+            self.spectrum_loader.set_background(background)
 
     def init_abs_background(self):
         """
-        Initialize the absorbance background of the CQDSpectrum class from blank sample absorbance spectra
+        Initialize the absorbance background of the collection from blank sample absorbance spectra.
+        Spectra measured at other wavelengths than the first blank spectrum are resampled onto its wavelengths.
         :return: Nothing
         """
-        blank_samples = []
-        blank_sample_comments = ['no sample in eppendorfrör (analysis is of water only)',
-                                 'sample missing (analysis is of water only)',
-                                 'Eppendorfrör empty - analysis is of water only',
-                                 'sample and protokoll missing (analysis is of water only)',
-                                 'sample missing - analysis is of water only',
-                                 'No sample, synthesis did not work - analysis is of water only',
-                                 'reference sample with only water']
-        _ = [blank_samples.append(x) for x in self.samples if x.comment in blank_sample_comments]
+        blank_samples = self.comment_index.get('blank', [])
         bg_abs_ys = []
         bg_abs_x = None
         for samp in blank_samples:
             if 'abs' not in samp.spectra:
                 continue
-            bg_abs_ys.append(samp.spectra['abs'].y_vectors['Abs'])
             if bg_abs_x is None:
                 bg_abs_x = samp.spectra['abs'].wl_vector
-            elif not np.array_equal(bg_abs_x, samp.spectra['abs'].wl_vector):
-                raise ValueError('Error initializing absorbance background. Sample {} has different wl_vector'
-                                 .format(samp))
+            bg_abs_ys.append(samp.spectra['abs'].resampled(bg_abs_x).y_vectors['Abs'])
 
         bg_abs_ys = np.array(bg_abs_ys)
         mean_y = bg_abs_ys.mean(axis=0)
-        CQDSpectrum.bg_abs_x = bg_abs_x
-        CQDSpectrum.bg_abs_y = mean_y
+        self.set_background(self.background.with_absorbance(bg_abs_x, mean_y))
+
+
+def comment_category(comment):
+    """
+    :param comment: comment of a sample in the map file
+    :return: 'blank' for blank samples, see blank_sample_comments, 'none' for samples without comment, otherwise 'note'
+    """
+    if comment in blank_sample_comments:
+        return 'blank'
+    return 'none' if not comment else 'note'
+
+
+# Keys of a sample per CQDCollection.query() filter
+_filter_keys = {'klass': lambda s: (s.klass,),
+                'reactant': lambda s: s.reactants,
+                'comment': lambda s: (comment_category(s.comment),),
+                'plate': lambda s: (s.plate,)}
+
+
+def _saturation(wl_vector, over):
+    """
+    :param wl_vector: numpy array of wavelengths
+    :param over: boolean numpy array of shape (..., wavelengths) marking saturated points
+    :return: (n_over, first_wl, last_wl) numpy arrays of shape over.shape[:-1], wavelengths are nan without
+        saturated points
+    """
+    n_over = over.sum(axis=-1)
+    any_over = n_over > 0
+    first = np.where(any_over, wl_vector[over.argmax(axis=-1)], np.nan)
+    last = np.where(any_over, wl_vector[over.shape[-1] - 1 - over[..., ::-1].argmax(axis=-1)], np.nan)
+    return n_over, first, last
+
+
+def _sample_fields(samples):
+    """
+    :param samples: list of CQDSample
+    :return: dict of numpy arrays label, plate, well and klass, one element per sample
+    """
+    return {'label': np.array([s.label for s in samples], dtype=str).reshape(-1),
+            'plate': np.array([s.plate for s in samples], dtype=int).reshape(-1),
+            'well': np.array([s.well for s in samples], dtype=int).reshape(-1),
+            'klass': np.array([s.klass for s in samples], dtype=str).reshape(-1)}
+
+
+def _reactant_fields(samples):
+    """
+    :param samples: list of CQDSample
+    :return: dict of numpy arrays reactant1 and reactant2, '' where the sample has no such reactant
+    """
+    return {'reactant{}'.format(i + 1): np.array([str(s.reactants[i]) if len(s.reactants) > i else ''
+                                                  for s in samples], dtype=str).reshape(-1) for i in range(2)}
+
+
+def _concat_columns(parts, dtypes):
+    """
+    :param parts: list of dicts of equal length numpy arrays
+    :param dtypes: dict of column name -> dtype, used for the empty columns if parts is empty
+    :return: dict of concatenated numpy arrays
+    """
+    if not parts:
+        return {k: np.zeros(0, dtype=t) for k, t in dtypes.items()}
+    return {k: np.concatenate([p[k] for p in parts]) for k in dtypes}
+
+
+def _to_records(columns):
+    """
+    :param columns: dict of column name -> equal length numpy arrays
+    :return: numpy structured array with one field per column
+    """
+    dtype = [(k, 'U{}'.format(max(1, v.dtype.itemsize // 4)) if v.dtype.kind == 'U' else v.dtype)
+             for k, v in columns.items()]
+    n = len(next(iter(columns.values()))) if columns else 0
+    out = np.empty(n, dtype=dtype)
+    for k, v in columns.items():
+        out[k] = v
+    return out
+
+
+def _as_number(x):
+    # Gains are integers in the spectrometer sheets, keep them as int for background lookup and messages
+    return int(x) if float(x).is_integer() else float(x)
+
+
+def data_paths(path):
+    """
+    :param path: path to data directory
+    :return: list of paths to the measurement workbook, the well plate map and the fluorescence baseline file
+    """
+    if not os.path.isdir(path):
+        raise NotADirectoryError(path + ' is not an existing directory')
+
+    # cqd2_path = os.path.join(path, 'CQD_measurements2.xlsx')
+    cqd2_path = os.path.join(path, 'CQD_measurements_abs adjusted_fluor adjusted.xlsx')
+    if not os.path.isfile(cqd2_path):
+        raise FileNotFoundError(cqd2_path + ' does not exist')
+
+    # map_path = os.path.join(path, 'Well plate map.xlsx')
+    map_path = os.path.join(path, 'Well plate map_7oct24.xlsx')
+    if not os.path.isfile(map_path):
+        raise FileNotFoundError(map_path + ' does not exist')
+
+    flu_bg_path = os.path.join(path, 'Fluorescence baseline.xlsx')
+    if not os.path.isfile(flu_bg_path):
+        raise FileNotFoundError(flu_bg_path + ' does not exist')
+    return [cqd2_path, map_path, flu_bg_path]
+
+
+def sheet_plate(sheet_name):
+    """
+    :param sheet_name: name of a measurement worksheet, ending with the plate index
+    :return: plate index
+    """
+    try:
+        return int(re.match('.*?([0-9]+)$', sheet_name).group(1))
+    except AttributeError:
+        raise ValueError('Invalid worksheet name: {}'.format(sheet_name))
+
+
+def read_map_book(map_path):
+    """
+    Parses the 'Well plate map.xls' file
+    :param map_path: path to the map file
+    :return: list of (label, plate, well, klass, comment, reactants) tuples in map order, CQDSample arguments
+    """
+    map_book = load_workbook(map_path)
+    ms = map_book.active
+    plate = None
+    well_mod = None
+    entries = []
+    for row in ms.iter_rows(min_row=1, max_col=7, values_only=True):
+        if row[0] == 'Plate':
+            plate = row[1]  # New plate
+        if row[0] == 'A':
+            well_mod = 0  # First row of plate
+        if row[0] == 'E':
+            well_mod = 12  # Second row of plate
+
+        reactants = []
+        if row[3] is not None:
+            reactants.append(row[3])
+        if row[4] is not None:
+            reactants.append(row[4])
+
+        if row[2] is not None:
+            klass = row[5].strip().upper()
+            entries.append((str(row[2]), plate, well_mod + row[1], klass, row[6], reactants))
+    map_book.close()
+    return entries
+
+
+def map_fingerprints(entries):
+    """
+    :param entries: sample entries from read_map_book()
+    :return: dict{str(plate): sha256 of the entries of the plate}
+    """
+    by_plate = {}
+    for entry in entries:
+        by_plate.setdefault(str(entry[1]), []).append(entry)
+    return {plate: hashlib.sha256(repr(rows).encode('utf-8')).hexdigest() for plate, rows in by_plate.items()}
+
+
+def input_fingerprints(cqd2_path, map_entries, flu_bg_path):
+    """
+    Content hashes of the input files at the granularity refresh() works with
+    :param cqd2_path: path to the measurement workbook
+    :param map_entries: sample entries from read_map_book()
+    :param flu_bg_path: path to the fluorescence baseline file
+    :return: dict with 'sheets': dict{sheet name: hash}, 'map': dict{str(plate): hash} and 'baseline': hash
+    """
+    return {'sheets': CQDCache.sheet_hashes(cqd2_path),
+            'map': map_fingerprints(map_entries),
+            'baseline': CQDCache.file_hash(flu_bg_path)}
 
 
 def parse_spectrometer_label(label):
@@ -312,3 +1124,163 @@ def parse_spectrometer_label(label):
     else:
         well = int(label[6:])
     return well, spec_type
+
+
+def read_xlsx_sheet_spectra(xlsx_path, sheet_name, wells, backend=None, timed=True):
+    """
+    Parses one measurement worksheet. Used as a worker process function by CQDCollection.parse_parallel.
+    :param xlsx_path: path to the measurement workbook
+    :param sheet_name: name of worksheet to parse
+    :param wells: set of well indexes with initialized samples, blocks for other wells are not converted
+    :param backend: reader backend, see CQDReaders.open_reader()
+    :param timed: if False the parse is not timed and rows are not counted, e.g. when the caller's stats are disabled
+    :return: (spectra, seconds, rows_read): list of (label, CQDSpectrum or None) in block order or None if the sheet
+        does not exist, wall time of parsing the sheet and number of worksheet rows read, 0 if not timed
+    """
+    stats = PipelineStats(enabled=timed)
+    with open_reader(xlsx_path, backend) as reader:
+        try:
+            sheet_rows = reader.iter_rows(sheet_name)
+        except KeyError:
+            return None, 0.0, 0
+        spectra = []
+        with stats.stage('parse_xlsx_sheet'):
+            for label, start_t, end_t, attrib_col, value_col, rows in iter_spectrum_blocks(
+                    stats.counted(sheet_rows, 'rows_read')):
+                spectrum = None
+                if parse_spectrometer_label(label)[0] in wells:
+                    spectrum = CQDSpectrum.spectrum_from_xl_data(start_t, end_t, attrib_col, value_col, rows)
+                spectra.append((label, spectrum))
+        return spectra, stats.times.get('parse_xlsx_sheet', 0.0), stats.counters.get('rows_read', 0)
+
+
+def read_abs_background(book, plate_sheets, plate_entries):
+    """
+    Absorbance background from the blank samples in one pass over the worksheets, see
+    CQDCollection.init_abs_background(). Only the absorbance blocks of blank wells are converted and the
+    background is summed plate by plate, on the wavelengths of the first blank spectrum.
+    :param book: SheetReader of the measurement workbook
+    :param plate_sheets: dict{plate: list of sheet names}
+    :param plate_entries: dict{plate: list of sample entries}, see read_map_book()
+    :return: (wl_vector, mean absorbance), (None, None) if there are no blank absorbance spectra
+    """
+    bg_abs_x = None
+    total = None
+    n = 0
+    for plate, sheet_names in plate_sheets.items():
+        blanks = [entry for entry in plate_entries.get(plate, []) if entry[4] in blank_sample_comments]
+        wells = {entry[2] for entry in blanks}
+        if not wells:
+            continue
+        spectra = {}  # well -> absorbance spectrum, later blocks replace earlier as when parsing the sheet
+        for sheet_name in sheet_names:
+            for label, start_t, end_t, attrib_col, value_col, rows in iter_spectrum_blocks(book.iter_rows(sheet_name)):
+                well, spec_type = parse_spectrometer_label(label)
+                if spec_type == 'abs' and well in wells:
+                    spectra[well] = CQDSpectrum.spectrum_from_xl_data(start_t, end_t, attrib_col, value_col, rows)
+
+        for entry in blanks:
+            spectrum = spectra.get(entry[2])
+            if spectrum is None:
+                continue
+            if bg_abs_x is None:
+                bg_abs_x = spectrum.wl_vector
+                total = np.array(spectrum.resampled(bg_abs_x).y_vectors['Abs'], dtype=float)
+            else:
+                total = total + spectrum.resampled(bg_abs_x).y_vectors['Abs']
+            n += 1
+    if n == 0:
+        return None, None
+    return bg_abs_x, total / n
+
+
+def read_flu_bg_spectra(flu_bg_path, backend=None):
+    """
+    Parses the first worksheet of the 'Fluorescence baseline.xlsx' file
+    :param flu_bg_path: path to the fluorescence baseline file
+    :param backend: reader backend, see CQDReaders.open_reader()
+    :return: list of CQDSpectrum
+    """
+    with open_reader(flu_bg_path, backend) as reader:
+        blocks = iter_spectrum_blocks(reader.iter_rows(reader.sheet_names[0]))
+        return [CQDSpectrum.spectrum_from_xl_data(start_t, end_t, attrib_col, value_col, rows)
+                for _, start_t, end_t, attrib_col, value_col, rows in blocks]
+
+
+class _PendingBlock:
+    """Spectrum block that has been opened by a 'Label: ' row but is not yet complete"""
+    def __init__(self, label):
+        self.label = label
+        self.start_t = None
+        self.end_t = None
+        self.attrib_col = []
+        self.value_col = []
+        self.rows = []
+        self.found_start = False
+        self.found_end = False
+        self.found_wl = False
+        self.in_data = False
+        self.data_done = False
+
+    def feed(self, first, row):
+        """
+        Advance the block with the next worksheet row
+        :param first: value of the first cell of the row
+        :param row: tuple of cell values
+        """
+        if not self.found_start:
+            if first == 'Start Time:':
+                self.found_start = True
+                self.start_t = _cell(row, 1)
+            else:
+                self.attrib_col.append(first)
+                self.value_col.append(_cell(row, 4))
+        if not self.found_end and first == 'End Time:':
+            self.found_end = True
+            self.end_t = _cell(row, 1)
+        if not self.found_wl and first == 'Wavel.':
+            self.found_wl = True
+            self.in_data = True
+        if self.in_data:
+            if first is None:
+                self.in_data = False
+                self.data_done = True
+            else:
+                try:
+                    self.rows.append(list(row[:row.index(None)]))
+                except ValueError:
+                    self.rows.append(list(row))
+
+    @property
+    def complete(self):
+        return self.found_start and self.found_end and self.data_done
+
+
+def _cell(row, col):
+    # Rows from read-only worksheets can be shorter than the sheet when trailing cells are empty
+    return row[col] if col < len(row) else None
+
+
+def iter_spectrum_blocks(rows):
+    """
+    Single forward pass state machine over the rows of a spectrometer worksheet.
+    A block starts at a 'Label: ' row. Attribute/value pairs (column A/E) are collected until the 'Start Time:' row,
+    the data rows are collected from the 'Wavel.' row until the first row with an empty first cell, and the block is
+    yielded when the 'End Time:' row has also been seen.
+    :param rows: iterable of row value tuples, e.g. SheetReader.iter_rows()
+    :return: generator of (label, start_t, end_t, attrib_col, value_col, rows) tuples in label order
+    """
+    pending = []
+    for row in rows:
+        first = _cell(row, 0)
+        for block in pending:
+            block.feed(first, row)
+        if isinstance(first, str) and first.startswith('Label: '):
+            pending.append(_PendingBlock(first))
+        while pending and pending[0].complete:
+            b = pending.pop(0)
+            yield b.label, b.start_t, b.end_t, b.attrib_col, b.value_col, b.rows
+    # A data block running into the end of the sheet is complete as well
+    for b in pending:
+        if b.found_start and b.found_end and b.found_wl:
+            yield b.label, b.start_t, b.end_t, b.attrib_col, b.value_col, b.rows
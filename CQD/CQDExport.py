@@ -0,0 +1,159 @@
+import csv
+import numpy as np
+
+# Fields of the long format, one row per spectrum point. Saturated ('OVER') points have value nan.
+long_fields = ('label', 'plate', 'well', 'klass', 'spec_type', 'channel', 'wl', 'value', 'saturated')
+# Fields of the wide format before the values, one row per sample and channel
+wide_fields = ('label', 'plate', 'well', 'klass', 'channel')
+# Default number of rows per chunk, chunks hold whole samples
+chunk_rows = 1 << 16
+
+
+def _width(values):
+    # Width of a fixed size numpy string field holding all values
+    return max([len(str(v)) for v in values] + [1])
+
+
+def long_dtype(tables):
+    """
+    :param tables: list of SpectrumTable
+    :return: numpy structured dtype of the long format, string fields are as wide as the longest value
+    """
+    samples = [s for t in tables for s in t.samples]
+    return np.dtype([('label', 'U{}'.format(_width(s.label for s in samples))),
+                     ('plate', int),
+                     ('well', int),
+                     ('klass', 'U{}'.format(_width(s.klass for s in samples))),
+                     ('spec_type', 'U{}'.format(_width(t.spec_type for t in tables))),
+                     ('channel', 'U{}'.format(_width(c for t in tables for c in t.channels))),
+                     ('wl', float),
+                     ('value', float),
+                     ('saturated', bool)])
+
+
+def wide_dtype(table):
+    """
+    :param table: SpectrumTable
+    :return: numpy structured dtype of the wide format, the field 'values' holds the spectrum of one channel
+    """
+    return np.dtype([('label', 'U{}'.format(_width(s.label for s in table.samples))),
+                     ('plate', int),
+                     ('well', int),
+                     ('klass', 'U{}'.format(_width(s.klass for s in table.samples))),
+                     ('channel', 'U{}'.format(_width(table.channels))),
+                     ('values', float, (len(table.wl_vector),))])
+
+
+def _sample_chunks(table, rows_per_sample, max_rows):
+    # Slices of whole samples of a table with at most max_rows rows, at least one sample each
+    step = max(1, max_rows // max(1, rows_per_sample))
+    for start in range(0, len(table), step):
+        yield slice(start, min(start + step, len(table)))
+
+
+def _fill_sample_fields(out, samples, repeat):
+    # Sample metadata fields, each sample repeated for its rows
+    out['label'] = np.repeat(np.array([str(s.label) for s in samples]), repeat)
+    out['plate'] = np.repeat(np.array([s.plate for s in samples]), repeat)
+    out['well'] = np.repeat(np.array([s.well for s in samples]), repeat)
+    out['klass'] = np.repeat(np.array([str(s.klass) for s in samples]), repeat)
+
+
+def iter_long(tables, data, dtype, max_rows=chunk_rows):
+    """
+    Long format rows of packed spectra, chunk by chunk. Rows are ordered by table, sample, channel and wavelength.
+    :param tables: list of SpectrumTable
+    :param data: dict{spec_type: numpy array of shape (channels, samples, wavelengths)} of the values, e.g. the
+        table data or CQDCollection.subtract_all(). Points are flagged saturated where the table marks them 'OVER',
+        see SpectrumTable.over.
+    :param dtype: dtype from long_dtype()
+    :param max_rows: maximum number of rows per chunk unless a single sample has more
+    :return: generator of numpy structured arrays
+    """
+    for table in tables:
+        n_channels, n_wl = len(table.channels), len(table.wl_vector)
+        channels = np.repeat(np.array(table.channels), n_wl)
+        for sel in _sample_chunks(table, n_channels * n_wl, max_rows):
+            samples = table.samples[sel]
+            out = np.empty(len(samples) * n_channels * n_wl, dtype=dtype)
+            _fill_sample_fields(out, samples, n_channels * n_wl)
+            out['spec_type'] = table.spec_type
+            out['channel'] = np.tile(channels, len(samples))
+            out['wl'] = np.tile(table.wl_vector, len(samples) * n_channels)
+            out['value'] = data[table.spec_type][:, sel].transpose(1, 0, 2).ravel()
+            out['saturated'] = table.over[:, sel].transpose(1, 0, 2).ravel()
+            yield out
+
+
+def iter_wide(table, values, dtype, max_rows=chunk_rows):
+    """
+    Wide format rows of one spectrum type, chunk by chunk. Rows are ordered by sample and channel.
+    :param table: SpectrumTable
+    :param values: numpy array of shape (channels, samples, wavelengths) of the values
+    :param dtype: dtype from wide_dtype()
+    :param max_rows: maximum number of rows per chunk unless a single sample has more
+    :return: generator of numpy structured arrays
+    """
+    n_channels = len(table.channels)
+    for sel in _sample_chunks(table, n_channels, max_rows):
+        samples = table.samples[sel]
+        out = np.empty(len(samples) * n_channels, dtype=dtype)
+        _fill_sample_fields(out, samples, n_channels)
+        out['channel'] = np.tile(np.array(table.channels), len(samples))
+        out['values'] = values[:, sel].transpose(1, 0, 2).reshape(len(out), -1)
+        yield out
+
+
+def write_csv(path, header, chunks):
+    """
+    Write chunks of a structured array to a .csv file. Subarray fields are written as one column per element.
+    :param path: path of .csv file
+    :param header: list of column names
+    :param chunks: iterable of numpy structured arrays
+    :return: number of rows written
+    """
+    n = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for chunk in chunks:
+            if any(chunk.dtype[name].shape for name in chunk.dtype.names):
+                writer.writerows(_flat_row(r) for r in chunk.tolist())
+            else:
+                writer.writerows(chunk.tolist())
+            n += len(chunk)
+    return n
+
+
+def _flat_row(record):
+    # Record tuple with the elements of subarray fields in line
+    row = []
+    for v in record:
+        if isinstance(v, np.ndarray):
+            row.extend(v.tolist())
+        else:
+            row.append(v)
+    return row
+
+
+def write_npy(path, dtype, n_rows, chunks):
+    """
+    Write chunks of a structured array to a .npy file through a memory map, the array is never held in memory
+    :param path: path of .npy file
+    :param dtype: dtype of the chunks
+    :param n_rows: total number of rows of all chunks
+    :param chunks: iterable of numpy structured arrays
+    :return: number of rows written
+    """
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_rows,))
+    n = 0
+    try:
+        for chunk in chunks:
+            out[n:n + len(chunk)] = chunk
+            n += len(chunk)
+        if n != n_rows:
+            raise ValueError('Expected {} rows, got {}'.format(n_rows, n))
+        out.flush()
+    finally:
+        del out
+    return n
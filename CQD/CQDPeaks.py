@@ -0,0 +1,268 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Fit result of one trace, see fit_peaks()
+peak_dtype = [('center', float), ('fwhm', float), ('height', float), ('area', float), ('offset', float),
+              ('rmse', float), ('converged', bool)]
+models = ('gaussian', 'lorentzian')
+gauss_fwhm = 2 * np.sqrt(2 * np.log(2))  # FWHM of a Gaussian with sigma 1
+
+
+def detect_peaks(wl_vector, ys, smooth=5, rel_height=0.25, over=None):
+    """
+    Detects local maxima in a batch of spectra.
+    Spectra are smoothed with a moving average first. Saturated points are treated as the top of a peak, other nan
+    points, e.g. past the end of a row cut short, as the spectrum minimum.
+    :param wl_vector: numpy array of wavelength values, shape (wavelengths,)
+    :param ys: numpy array of spectra, shape (spectra, wavelengths)
+    :param smooth: width in points of the moving average
+    :param rel_height: minimum height of a peak above the spectrum minimum, relative to the spectrum maximum
+    :param over: boolean numpy array of the shape of ys marking saturated ('OVER') points, default the nan points
+    :return: boolean numpy array of shape (spectra, wavelengths), True at peaks.
+        Flat tops are marked at their first point.
+    """
+    filled = _fill_saturated(ys, _over(ys, over))
+    if smooth > 1:
+        filled = _moving_average(filled, smooth)
+    lo = np.nanmin(filled, axis=1, keepdims=True)
+    hi = np.nanmax(filled, axis=1, keepdims=True)
+    left = np.concatenate([np.full((len(filled), 1), -np.inf), filled[:, :-1]], axis=1)
+    right = np.concatenate([filled[:, 1:], np.full((len(filled), 1), -np.inf)], axis=1)
+    with np.errstate(invalid='ignore'):
+        return (filled > left) & (filled >= right) & (filled - lo >= rel_height * (hi - lo))
+
+
+def initial_guess(wl_vector, ys, over=None):
+    """
+    Initial peak parameters from the largest peak of each spectrum
+    :param wl_vector: numpy array of wavelength values, shape (wavelengths,)
+    :param ys: numpy array of spectra, shape (spectra, wavelengths)
+    :param over: boolean numpy array of the shape of ys marking saturated ('OVER') points, default the nan points.
+        Other nan points are left out.
+    :return: numpy array of shape (spectra, 4): height, center, half width (Gaussian sigma), offset.
+        Rows are nan for spectra without valid points.
+    """
+    x = np.asarray(wl_vector, dtype=float)
+    over = _over(ys, over)
+    valid = ~np.isnan(ys)
+    usable = valid.any(axis=1)
+    saturated = over.any(axis=1) & usable
+    offset = np.nanmin(np.where(usable[:, None], ys, 0), axis=1)
+    top = np.nanmax(np.where(usable[:, None], ys, 0), axis=1)
+
+    # Peak centre at the maximum, or at the middle of the saturated points
+    center = x[np.nanargmax(np.where(valid, ys, -np.inf), axis=1)]
+    sat_center = np.sum(np.where(over, x, 0), axis=1) / np.maximum(np.sum(over, axis=1), 1)
+    center = np.where(saturated, sat_center, center)
+
+    # Width from the number of points above half maximum
+    step = np.abs(np.mean(np.diff(x))) if len(x) > 1 else 1.0
+    with np.errstate(invalid='ignore'):
+        above = np.sum(over | (ys >= (offset + top)[:, None] / 2), axis=1)
+    sigma = np.maximum(above, 2) * step / gauss_fwhm
+    height = np.maximum(top - offset, np.finfo(float).eps)
+
+    p0 = np.stack([height, center, sigma, offset], axis=1)
+    p0[~usable] = np.nan
+    return p0
+
+
+def peak_model(x, p, model='gaussian'):
+    """
+    Evaluates a batch of peak models and their Jacobians
+    :param x: numpy array of wavelength values, shape (wavelengths,)
+    :param p: numpy array of parameters, shape (spectra, 4): height, center, width, offset.
+        width is sigma for 'gaussian' and the half width at half maximum for 'lorentzian'
+    :param model: 'gaussian' or 'lorentzian'
+    :return: (f, jac) of shapes (spectra, wavelengths) and (spectra, wavelengths, 4)
+    """
+    h, c, s, b = (p[:, i:i + 1] for i in range(4))
+    d = x[None, :] - c
+    if model == 'gaussian':
+        g = np.exp(-0.5 * (d / s) ** 2)
+        f = h * g + b
+        jac = np.stack([g, h * g * d / s ** 2, h * g * d ** 2 / s ** 3, np.ones_like(g)], axis=2)
+    elif model == 'lorentzian':
+        q = d ** 2 + s ** 2
+        g = s ** 2 / q
+        f = h * g + b
+        jac = np.stack([g, 2 * h * s ** 2 * d / q ** 2, 2 * h * s * d ** 2 / q ** 2, np.ones_like(g)], axis=2)
+    else:
+        raise ValueError('Unknown peak model {}, expected one of {}'.format(model, models))
+    return f, jac
+
+
+def fit_peaks(wl_vector, ys, model='gaussian', p0=None, window=2.0, max_iter=100, tol=1e-8, warm_start=True,
+              workers=None, over=None):
+    """
+    Fits one peak plus a constant offset to each spectrum in a batch.
+    All spectra are fitted together with a vectorized Levenberg-Marquardt iteration.
+    Saturated and other nan points get zero weight, so saturated peaks are fitted on their flanks.
+    Only points within window * FWHM of the initial peak centre are used.
+    Fits with the centre outside the range of the points used are not converged and their parameters are nan.
+    :param wl_vector: numpy array of wavelength values, shape (wavelengths,)
+    :param ys: numpy array of spectra, shape (spectra, wavelengths)
+    :param model: 'gaussian' or 'lorentzian'
+    :param p0: optional initial parameters, shape (spectra, 4), default from initial_guess()
+    :param window: half width of the fit window in units of the initial FWHM, None fits the whole spectrum
+    :param max_iter: maximum number of iterations
+    :param tol: relative change of the squared residual sum at convergence
+    :param warm_start: if True spectra that do not converge are refitted starting from the result of the nearest
+        converged neighbouring spectrum in the batch
+    :param workers: number of worker processes, the batch is split in one chunk per worker. None or 1 fits here.
+    :param over: boolean numpy array of the shape of ys marking saturated ('OVER') points, default the nan points.
+        Used for the initial guess, see initial_guess().
+    :return: numpy structured array with fields center, fwhm, height, area, offset, rmse and converged,
+        one row per spectrum
+    """
+    if model not in models:
+        raise ValueError('Unknown peak model {}, expected one of {}'.format(model, models))
+    x = np.asarray(wl_vector, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    over = _over(ys, over)
+    if workers is not None and workers > 1 and len(ys) > workers:
+        chunks = np.array_split(np.arange(len(ys)), workers)
+        p0_chunks = [None if p0 is None else p0[c] for c in chunks]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(fit_peaks, *zip(*[(x, ys[c], model, p, window, max_iter, tol, warm_start, None,
+                                                  over[c]) for c, p in zip(chunks, p0_chunks)]))
+            return np.concatenate(list(results))
+
+    if p0 is None:
+        p0 = initial_guess(x, ys, over)
+        if model == 'lorentzian':
+            p0[:, 2] *= gauss_fwhm / 2  # sigma -> half width at half maximum
+    p0 = np.array(p0, dtype=float)
+
+    weights = (~np.isnan(ys)).astype(float)
+    fitted = weights > 0
+    if window is not None:
+        fwhm0 = p0[:, 2:3] * (gauss_fwhm if model == 'gaussian' else 2)
+        with np.errstate(invalid='ignore'):
+            in_window = np.abs(x[None, :] - p0[:, 1:2]) <= window * fwhm0
+        weights *= in_window
+        fitted = (fitted | over) & in_window
+    else:
+        fitted = fitted | over
+    # Fitted range of each spectrum, saturated points included as they hold the top of the peak
+    lo = np.min(np.where(fitted, x, np.inf), axis=1)
+    hi = np.max(np.where(fitted, x, -np.inf), axis=1)
+    y = np.where(np.isnan(ys), 0, ys)
+
+    params, cost, converged = _levenberg_marquardt(x, y, weights, p0, model, max_iter, tol)
+    converged &= (params[:, 1] >= lo) & (params[:, 1] <= hi)
+
+    if warm_start:
+        ok = np.flatnonzero(converged)
+        failed = np.flatnonzero(~converged & (weights.sum(axis=1) >= 4))
+        if len(ok) and len(failed):
+            # Nearest converged neighbour, ties go to the previous spectrum
+            pos = np.searchsorted(ok, failed)
+            prev = ok[np.maximum(pos - 1, 0)]
+            nxt = ok[np.minimum(pos, len(ok) - 1)]
+            neighbour = np.where(np.abs(failed - prev) <= np.abs(nxt - failed), prev, nxt)
+            p_warm = params[neighbour].copy()
+            p_warm[:, 0] = p0[failed, 0]  # keep the height and offset of the spectrum itself
+            p_warm[:, 3] = p0[failed, 3]
+            p2, cost2, conv2 = _levenberg_marquardt(x, y[failed], weights[failed], p_warm, model, max_iter, tol)
+            conv2 &= (p2[:, 1] >= lo[failed]) & (p2[:, 1] <= hi[failed])
+            better = conv2 | (cost2 < cost[failed])
+            params[failed[better]] = p2[better]
+            cost[failed[better]] = cost2[better]
+            converged[failed[better]] = conv2[better]
+
+    # A centre outside the fitted range is an extrapolation, not a peak
+    outside = ~((params[:, 1] >= lo) & (params[:, 1] <= hi))
+    params[outside] = np.nan
+    cost[outside] = np.nan
+    return _peak_results(params, cost, weights, converged, model)
+
+
+def _levenberg_marquardt(x, y, weights, p0, model, max_iter, tol):
+    n = len(y)
+    params = p0.copy()
+    n_points = weights.sum(axis=1)
+    active = np.flatnonzero(~np.isnan(params).any(axis=1) & (n_points >= 4))
+    converged = np.zeros(n, dtype=bool)
+    cost = np.full(n, np.nan)
+    lam = np.full(n, 1e-3)
+
+    if len(active):
+        f, _ = peak_model(x, params[active], model)
+        cost[active] = np.sum(weights[active] * (y[active] - f) ** 2, axis=1)
+
+    for _ in range(max_iter):
+        if not len(active):
+            break
+        p = params[active]
+        w = weights[active]
+        f, jac = peak_model(x, p, model)
+        r = y[active] - f
+        jtj = np.einsum('nmi,nm,nmj->nij', jac, w, jac)
+        jtr = np.einsum('nmi,nm->ni', jac, w * r)
+        diag = np.einsum('nii->ni', jtj)
+        damping = lam[active, None] * (diag + 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300)
+        a = jtj + damping[:, :, None] * np.eye(4)[None, :, :]
+        try:
+            step = np.linalg.solve(a, jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('nij,nj->ni', np.linalg.pinv(a), jtr)
+
+        p_new = p + step
+        p_new[:, 2] = np.abs(p_new[:, 2])
+        f_new, _ = peak_model(x, p_new, model)
+        cost_new = np.sum(w * (y[active] - f_new) ** 2, axis=1)
+        old = cost[active]
+        improved = np.isfinite(cost_new) & (cost_new <= old)
+
+        params[active[improved]] = p_new[improved]
+        cost[active[improved]] = cost_new[improved]
+        lam[active] = np.where(improved, lam[active] / 10, lam[active] * 10)
+
+        done = improved & ((old - cost_new) <= tol * np.maximum(old, 1e-300))
+        converged[active[done]] = True
+        # Stalled fits: the step is negligible even without damping progress
+        stalled = lam[active] > 1e12
+        active = active[~(done | stalled)]
+    return params, cost, converged
+
+
+def _peak_results(params, cost, weights, converged, model):
+    h, c, s, b = params.T
+    out = np.empty(len(params), dtype=peak_dtype)
+    out['center'] = c
+    out['height'] = h
+    out['offset'] = b
+    if model == 'gaussian':
+        out['fwhm'] = gauss_fwhm * s
+        out['area'] = h * s * np.sqrt(2 * np.pi)
+    else:
+        out['fwhm'] = 2 * s
+        out['area'] = np.pi * h * s
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['rmse'] = np.sqrt(cost / weights.sum(axis=1))
+    out['converged'] = converged
+    return out
+
+
+def _over(ys, over):
+    # Saturated points, the nan points of spectra without an OVER mask
+    return np.isnan(ys) if over is None else np.asarray(over, dtype=bool)
+
+
+def _fill_saturated(ys, over):
+    # Saturated points are above every measured point of the spectrum, other nan points at its minimum
+    missing = np.isnan(ys)
+    top = np.max(np.where(missing, -np.inf, ys), axis=1, keepdims=True)
+    bottom = np.min(np.where(missing, np.inf, ys), axis=1, keepdims=True)
+    span = top - bottom
+    return np.where(over, top + np.maximum(span, 1), np.where(missing, bottom, ys))
+
+
+def _moving_average(ys, n):
+    # Centred moving average along the last axis, shorter windows at the ends
+    c = np.cumsum(np.pad(ys, ((0, 0), (1, 0))), axis=1)
+    m = ys.shape[1]
+    lo = np.clip(np.arange(m) - n // 2, 0, m)
+    hi = np.clip(np.arange(m) + n - n // 2, 0, m)
+    return (c[:, hi] - c[:, lo]) / (hi - lo)
@@ -0,0 +1,99 @@
+import numpy as np
+
+# Fluorescence channels of a sample, see CQDSpectrum.spectrum_from_xl_data
+reference_channel = 'Aq'
+metal_channels = ('Cu', 'Fe', 'Cd')
+# Per metal score fields, prefixed with the metal name, e.g. 'Cu_area_ratio'
+metal_fields = ('area_ratio', 'peak_ratio', 'shift')
+
+
+def quench_scores(wl_vector, data, channels, reference=reference_channel, metals=metal_channels):
+    """
+    Quench scores of a batch of fluorescence measurements, all spectra in one pass.
+    Integrals are taken over the wavelength intervals where both the reference and the metal spectrum are valid,
+    so saturated points (nan) are left out of both areas of a ratio.
+    :param wl_vector: numpy array of wavelength values, shape (wavelengths,)
+    :param data: numpy array of shape (channels, samples, wavelengths), e.g. from CQDCollection.subtract_all()
+    :param channels: channel keys of the first axis of data
+    :param reference: channel of the unquenched reference spectrum
+    :param metals: channels of the metal quenched spectra
+    :return: dict of numpy arrays, one element per sample:
+        ref_area: integrated reference spectrum,
+        ref_peak_wl: wavelength of the reference maximum,
+        <metal>_area_ratio: integrated metal spectrum / integrated reference spectrum,
+        <metal>_peak_ratio: metal spectrum / reference spectrum at the reference peak wavelength,
+        <metal>_shift: wavelength of the metal maximum - ref_peak_wl.
+        Values are nan where a spectrum has no valid points.
+    """
+    x = np.asarray(wl_vector, dtype=float)
+    ref = data[channels.index(reference)]
+    ref_valid = ~np.isnan(ref)
+    ref_peak = _argmax(ref)
+    rows = np.arange(ref.shape[0])
+
+    scores = {'ref_area': _integrate(x, ref, ref_valid),
+              'ref_peak_wl': np.where(ref_peak >= 0, x[np.maximum(ref_peak, 0)], np.nan)}
+    ref_top = np.where(ref_peak >= 0, ref[rows, np.maximum(ref_peak, 0)], np.nan)
+    for metal in metals:
+        y = data[channels.index(metal)]
+        valid = ref_valid & ~np.isnan(y)
+        peak = _argmax(y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scores[metal + '_area_ratio'] = _integrate(x, y, valid) / _integrate(x, ref, valid)
+            scores[metal + '_peak_ratio'] = np.where(ref_peak >= 0, y[rows, np.maximum(ref_peak, 0)], np.nan) / ref_top
+        scores[metal + '_shift'] = np.where(peak >= 0, x[np.maximum(peak, 0)], np.nan) - scores['ref_peak_wl']
+    return scores
+
+
+def aggregate(keys, values):
+    """
+    Group statistics of score columns, nan values are left out of the statistics of their column
+    :param keys: numpy array of group keys, one element per row
+    :param values: dict of numpy arrays of float, one element per row
+    :return: (groups, n_rows, stats). groups: sorted unique keys, n_rows: number of rows per group,
+        stats: dict{name: (count, mean, std)} of numpy arrays, one element per group
+    """
+    groups, inverse, n_rows = np.unique(keys, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    stats = {}
+    for name, v in values.items():
+        valid = ~np.isnan(v)
+        filled = np.where(valid, v, 0)
+        count = np.bincount(inverse, weights=valid, minlength=len(groups))
+        total = np.bincount(inverse, weights=filled, minlength=len(groups))
+        total_sq = np.bincount(inverse, weights=filled ** 2, minlength=len(groups))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+        stats[name] = (count.astype(int), mean, std)
+    return groups, n_rows, stats
+
+
+def top_n(values, n, largest=False):
+    """
+    Indexes of the n smallest (or largest) values in sorted order, nan values are never ranked
+    :param values: numpy array of float
+    :param n: number of indexes to return
+    :param largest: if True rank the largest values first
+    :return: numpy array of at most n indexes into values
+    """
+    candidates = np.flatnonzero(~np.isnan(values))
+    v = -values[candidates] if largest else values[candidates]
+    if n < len(candidates):
+        part = np.argpartition(v, n - 1)[:n]
+        candidates, v = candidates[part], v[part]
+    return candidates[np.argsort(v, kind='stable')]
+
+
+def _argmax(ys):
+    # Index of the maximum of each row ignoring nan, -1 for rows without valid points
+    valid = ~np.isnan(ys)
+    return np.where(valid.any(axis=1), np.argmax(np.where(valid, ys, -np.inf), axis=1), -1)
+
+
+def _integrate(x, ys, valid):
+    # Trapezoidal integral of each row over the intervals with both end points valid
+    seg = valid[:, 1:] & valid[:, :-1]
+    y = np.where(valid, ys, 0)
+    area = np.sum(np.where(seg, (y[:, 1:] + y[:, :-1]) * np.diff(x) / 2, 0), axis=1)
+    return np.where(seg.any(axis=1), area, np.nan)
@@ -0,0 +1,242 @@
+import os.path
+import zipfile
+from xml.etree import ElementTree
+from openpyxl import load_workbook
+from xlrd import open_workbook, XLRDError
+
+# Namespaces of the OOXML workbook parts
+spreadsheet_ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+office_rel_ns = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+package_rel_ns = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+
+class SheetReader:
+    """
+    Interface of the worksheet reader backends. A reader yields the rows of a worksheet as tuples of cell values,
+    like openpyxl ws.iter_rows(values_only=True): None for empty cells, numbers as int or float, text as str.
+    Rows can be shorter than the sheet when trailing cells are empty.
+    Backends differ for formula cells: openpyxl returns the formula text, e.g. '=B2-B3', ooxml and xlrd the value
+    cached by the program that saved the file, None if it saved none.
+    """
+    def __init__(self, path):
+        self.path = path  # path of the workbook file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, os.path.basename(self.path))
+
+    @property
+    def sheet_names(self):
+        """
+        :return: list of worksheet names in workbook order
+        """
+        raise NotImplementedError
+
+    def iter_rows(self, sheet_name):
+        """
+        :param sheet_name: name of worksheet
+        :return: iterator of row value tuples, raises KeyError if the sheet does not exist
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class OpenpyxlReader(SheetReader):
+    """Reads .xlsx files with openpyxl in read-only mode, formula cells are returned as formula text"""
+    def __init__(self, path):
+        super().__init__(path)
+        self.book = load_workbook(path, read_only=True)
+
+    @property
+    def sheet_names(self):
+        return self.book.sheetnames
+
+    def iter_rows(self, sheet_name):
+        return self.book[sheet_name].iter_rows(values_only=True)
+
+    def close(self):
+        self.book.close()
+
+
+class OOXMLReader(SheetReader):
+    """
+    Reads .xlsx files by streaming the worksheet xml out of the zip archive with incremental xml parsing,
+    without openpyxl cell objects. Shared strings are resolved once when the reader is opened.
+    Number formats are not applied, numeric cells formatted as dates are returned as numbers.
+    Formula cells are returned as their cached value like with openpyxl load_workbook(data_only=True), not as the
+    formula text OpenpyxlReader returns. Spectrum values computed with formulas in Excel are read as numbers.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.zip = zipfile.ZipFile(path)
+        self.members = dict(workbook_sheet_members(self.zip))  # sheet name -> xml member of the archive
+        self.shared_strings = read_shared_strings(self.zip)
+
+    @property
+    def sheet_names(self):
+        return list(self.members.keys())
+
+    def iter_rows(self, sheet_name):
+        member = self.members[sheet_name]
+        return self._iter_rows(member)
+
+    def _iter_rows(self, member):
+        sheet_data_tag = '{%s}sheetData' % spreadsheet_ns
+        row_tag = '{%s}row' % spreadsheet_ns
+        c_tag = '{%s}c' % spreadsheet_ns
+        v_tag = '{%s}v' % spreadsheet_ns
+        is_tag = '{%s}is' % spreadsheet_ns
+        shared = self.shared_strings
+        columns = {}  # column letters -> index, shared by all rows
+        last_row = 0
+        sheet_data = None
+        with self.zip.open(member) as f:
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if sheet_data is None and elem.tag == sheet_data_tag:
+                        sheet_data = elem
+                    continue
+                if elem.tag != row_tag:
+                    continue
+                r = elem.get('r')
+                row_idx = int(r) if r is not None else last_row + 1
+                for _ in range(last_row + 1, row_idx):
+                    yield ()  # rows without cells are left out of the xml
+                last_row = row_idx
+
+                values = []
+                for c in elem.iter(c_tag):
+                    ref = c.get('r')
+                    if ref is not None:
+                        letters = ref.rstrip('0123456789')
+                        col = columns.get(letters)
+                        if col is None:
+                            col = columns[letters] = _column_index(letters)
+                        if col > len(values):
+                            values.extend([None] * (col - len(values)))
+                    t = c.get('t')
+                    if t == 'inlineStr':
+                        is_elem = c.find(is_tag)
+                        values.append(None if is_elem is None else ''.join(is_elem.itertext()))
+                        continue
+                    v = c.findtext(v_tag)
+                    if not v:
+                        values.append(None)  # also formula cells saved without a cached value
+                    elif t is None or t == 'n':
+                        values.append(float(v) if '.' in v or 'E' in v or 'e' in v else int(v))
+                    elif t == 's':
+                        values.append(shared[int(v)])
+                    elif t == 'b':
+                        values.append(bool(int(v)))
+                    else:
+                        values.append(v)  # 'str', 'e' and 'd' cells as text
+                # Finished rows are dropped from the tree, memory is bounded by one row and not the sheet
+                if sheet_data is not None:
+                    sheet_data.remove(elem)
+                elem.clear()
+                yield tuple(values)
+
+    def close(self):
+        self.zip.close()
+
+
+class XlrdReader(SheetReader):
+    """Reads legacy .xls files with xlrd, sheets are loaded on demand and unloaded when read"""
+    def __init__(self, path):
+        super().__init__(path)
+        self.book = open_workbook(path, on_demand=True)
+
+    @property
+    def sheet_names(self):
+        return self.book.sheet_names()
+
+    def iter_rows(self, sheet_name):
+        try:
+            ws = self.book.sheet_by_name(sheet_name)
+        except XLRDError:
+            raise KeyError(sheet_name)
+        return self._iter_rows(ws, sheet_name)
+
+    def _iter_rows(self, ws, sheet_name):
+        try:
+            for i in range(ws.nrows):
+                # xlrd returns '' for empty cells, numbers as float
+                yield tuple(None if v == '' else int(v) if isinstance(v, float) and v.is_integer() else v
+                            for v in ws.row_values(i))
+        finally:
+            self.book.unload_sheet(sheet_name)  # close sheet to save memory
+
+    def close(self):
+        self.book.release_resources()
+
+
+# Reader backends by name, see open_reader()
+backends = {'openpyxl': OpenpyxlReader,
+            'ooxml': OOXMLReader,
+            'xlrd': XlrdReader}
+
+
+def open_reader(path, backend=None):
+    """
+    :param path: path of .xlsx or .xls workbook
+    :param backend: 'openpyxl', 'ooxml' or 'xlrd'. None picks xlrd for .xls files and openpyxl otherwise.
+    :return: SheetReader instance
+    """
+    if backend is None:
+        backend = 'xlrd' if path.lower().endswith('.xls') else 'openpyxl'
+    try:
+        reader = backends[backend]
+    except KeyError:
+        raise ValueError('Unknown reader backend {}, expected one of {}'.format(backend, list(backends.keys())))
+    return reader(path)
+
+
+def workbook_sheet_members(z):
+    """
+    :param z: zipfile.ZipFile of an .xlsx workbook
+    :return: list of (sheet name, archive member of the worksheet xml) in workbook order
+    """
+    workbook = ElementTree.fromstring(z.read('xl/workbook.xml'))
+    rels = ElementTree.fromstring(z.read('xl/_rels/workbook.xml.rels'))
+    targets = {r.get('Id'): r.get('Target') for r in rels.iter('{%s}Relationship' % package_rel_ns)}
+    members = []
+    for sheet in workbook.iter('{%s}sheet' % spreadsheet_ns):
+        target = targets[sheet.get('{%s}id' % office_rel_ns)]
+        members.append((sheet.get('name'), target.lstrip('/') if target.startswith('/') else 'xl/' + target))
+    return members
+
+
+def read_shared_strings(z):
+    """
+    :param z: zipfile.ZipFile of an .xlsx workbook
+    :return: list of shared strings, rich text runs are joined
+    """
+    if 'xl/sharedStrings.xml' not in z.namelist():
+        return []
+    si_tag = '{%s}si' % spreadsheet_ns
+    t_tag = '{%s}t' % spreadsheet_ns
+    r_tag = '{%s}r' % spreadsheet_ns
+    strings = []
+    with z.open('xl/sharedStrings.xml') as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag == si_tag:
+                # Plain text or rich text runs, phonetic runs (rPh) are not part of the value
+                strings.append(''.join((child.text or '') if child.tag == t_tag else (child.findtext(t_tag) or '')
+                                       for child in elem if child.tag in (t_tag, r_tag)))
+                elem.clear()
+    return strings
+
+
+def _column_index(letters):
+    # 'A' -> 0, 'AA' -> 26
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return col - 1
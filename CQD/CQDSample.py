@@ -1,4 +1,7 @@
+import os
 import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill
 from openpyxl.chart import ScatterChart, Reference
 # If I just import Series my IDE gives and error, but it still works
@@ -41,13 +44,14 @@ class CQDSample:
 
     def write_work_sheet(self, wb):
         """
-        Append a worksheet to the workbook and write sample data to it
+        Append a worksheet to the workbook and write sample data to it.
+        Works with both normal and write-only workbooks.
         :param wb: Workbook to append worksheet to
         :return: none
         """
-        ws = wb.create_sheet(title=self.label)
+        ws = RowWriter(wb.create_sheet(title=self.label))
         charts = []
-        ws.column_dimensions['A'].best_fit = True
+        ws.ws.column_dimensions['A'].best_fit = True
         ws.append(['Klass:', self.klass])
         ws.append(['Prov:', self.label])
         if self.comment:
@@ -56,35 +60,115 @@ class CQDSample:
             ws.append(['Inget avvikande noterat vid analys!'])
         ws.append([])  # 1 blank rows
 
-        ws.append(['Absorbansmätning'])
-        ws.cell(ws.max_row, 1).font = ft_heading
+        ws.append(['Absorbansmätning'], font=ft_heading)
         write_spectrum(ws, charts, self, 'abs')
         ws.append([])  # 1 blank rows
 
-        ws.append(['Flourescensmätning med 350 nm excitationsvåglängd'])
-        ws.cell(ws.max_row, 1).font = ft_heading
+        ws.append(['Flourescensmätning med 350 nm excitationsvåglängd'], font=ft_heading)
         write_spectrum(ws, charts, self, 'ex350')
         ws.append([])  # 1 blank rows
 
-        ws.append(['Flourescensmätning med 400 nm excitationsvåglängd'])
-        ws.cell(ws.max_row, 1).font = ft_heading
+        ws.append(['Flourescensmätning med 400 nm excitationsvåglängd'], font=ft_heading)
         write_spectrum(ws, charts, self, 'ex400')
 
-        anchor_row = ws.max_row+2
+        anchor_row = ws.row+2
         anchor_cols = iter(['A', 'J', 'T'])
         for chart in charts:
-            ws.add_chart(chart, '{}{}'.format(next(anchor_cols), anchor_row))
+            ws.ws.add_chart(chart, '{}{}'.format(next(anchor_cols), anchor_row))
+
+
+class RowWriter:
+    """Appends rows to a normal or write-only worksheet and keeps track of the last written row"""
+    def __init__(self, ws):
+        self.ws = ws  # openpyxl Worksheet or WriteOnlyWorksheet
+        self.row = 0  # index of last written row
+
+    def append(self, values, font=None, fill=None):
+        """
+        Append a row of values
+        :param values: list of cell values
+        :param font: optional Font applied to the first cell
+        :param fill: optional PatternFill applied to all cells
+        """
+        if font is not None or fill is not None:
+            values = [WriteOnlyCell(self.ws, value=v) for v in values]
+            if font is not None and values:
+                values[0].font = font
+            if fill is not None:
+                for c in values:
+                    c.fill = fill
+        self.ws.append(values)
+        self.row += 1
+
+
+def write_workbook(path, samples):
+    """
+    Write a write-only workbook with one worksheet per sample
+    :param path: path of .xlsx file to write
+    :param samples: list of CQDSample
+    :return: path
+    """
+    wb = Workbook(write_only=True)
+    for samp in samples:
+        samp.write_work_sheet(wb)
+    wb.save(path)
+    wb.close()
+    return path
+
+
+class ReportWriter:
+    """
+    Writes samples as they arrive to one write-only workbook per klass, '<klass>.xlsx' like
+    CQDCollection.write_reports(). Each worksheet is closed when written, so samples can be streamed from
+    CQDCollection.iter_samples() without keeping them in memory. Workbooks are saved by close().
+    """
+    def __init__(self, out_dir):
+        self.out_dir = out_dir  # directory to write the workbooks to, created if missing
+        self.books = {}  # klass -> open write-only Workbook
+        os.makedirs(out_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, sample):
+        """
+        Append a worksheet for the sample to the workbook of its klass
+        :param sample: CQDSample
+        """
+        wb = self.books.get(sample.klass)
+        if wb is None:
+            wb = self.books[sample.klass] = Workbook(write_only=True)
+        sample.write_work_sheet(wb)
+        wb.worksheets[-1].close()
+
+    def close(self):
+        """
+        Save and close all workbooks
+        :return: list of paths of written workbooks
+        """
+        paths = []
+        for klass, wb in self.books.items():
+            path = os.path.join(self.out_dir, '{}.xlsx'.format(klass))
+            wb.save(path)
+            wb.close()
+            paths.append(path)
+        self.books = {}
+        return paths
 
 
 def to_list_nan(vec):  # Utility function to convert numpy arrays to lists with nan values replaced by 'Nan'
     li = vec.tolist()
-    return ['Nan' if np.isnan(x) else x for x in li]
+    for i in np.flatnonzero(np.isnan(vec)).tolist():
+        li[i] = 'Nan'
+    return li
 
 
-def write_spectrum(ws, charts, sample, spec_key):  # Utility function to write spectrum to worksheet
+def write_spectrum(ws, charts, sample, spec_key):  # Utility function to write spectrum to a RowWriter
     if spec_key not in sample.spectra.keys():
-        ws.append(['Ingen data'])
-        ws.cell(ws.max_row, 1).font = ft_warning
+        ws.append(['Ingen data'], font=ft_warning)
         return
     spec = sample.spectra[spec_key]
 
@@ -96,10 +180,8 @@ def write_spectrum(ws, charts, sample, spec_key):  # Utility function to write s
     chart.x_axis.title = 'våglängd [nm]'
     chart.y_axis.title = y_names[spec_key]
 
-    ws.append(['Våglängd [nm]'] + to_list_nan(spec.wl_vector))
-    for c in next(ws.iter_rows(min_row=ws.max_row, max_col=len(spec.wl_vector)+1)):
-        c.fill = PatternFill('solid', fgColor=wl_color)
-    xvalues = Reference(ws, min_col=2, max_col=len(spec.wl_vector)+1, min_row=ws.max_row, max_row=ws.max_row)
+    ws.append(['Våglängd [nm]'] + to_list_nan(spec.wl_vector), fill=PatternFill('solid', fgColor=wl_color))
+    xvalues = Reference(ws.ws, min_col=2, max_col=len(spec.wl_vector)+1, min_row=ws.row, max_row=ws.row)
     chart.x_axis.scaling.min = spec.wl_vector.min()
     chart.x_axis.scaling.max = spec.wl_vector.max()
 
@@ -110,7 +192,7 @@ def write_spectrum(ws, charts, sample, spec_key):  # Utility function to write s
 
     for key, val in y_vecs.items():
         ws.append([spec_names[key]] + to_list_nan(val))
-        yvalues = Reference(ws, min_col=1, max_col=len(spec.wl_vector)+1, min_row=ws.max_row, max_row=ws.max_row)
+        yvalues = Reference(ws.ws, min_col=1, max_col=len(spec.wl_vector)+1, min_row=ws.row, max_row=ws.row)
         series = Series(yvalues, xvalues, title_from_data=True)
         chart.series.append(series)
 
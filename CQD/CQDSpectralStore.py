@@ -0,0 +1,136 @@
+import numpy as np
+from CQD.Resampler import common_grid, grid_key, resampler_for, same_grid
+
+
+class SpectrumTable:
+    """Columnar data of all spectra of one spectrum type in a collection"""
+    def __init__(self, spec_type, channels, wl_vector, data, samples, meta_data, resampled=None, over=None):
+        self.spec_type = spec_type  # spectrum type key, e.g. 'abs' or 'ex350'
+        self.channels = channels  # tuple of y_vectors keys, order of the first axis of data
+        self.wl_vector = wl_vector  # numpy array of wavelength values shared by all rows
+        self.data = data  # numpy array of shape (channels, samples, wavelengths)
+        # boolean numpy array of the shape of data marking saturated ('OVER') points, default the nan points
+        self.over = np.isnan(data) if over is None else over
+        self.samples = samples  # list of CQDSample, row index of data -> sample
+        self.meta_data = meta_data  # list of meta data dicts, one per row
+        self.rows = {id(s): i for i, s in enumerate(samples)}  # id(sample) -> row index
+        self.gains = np.array([m.get('gain', np.nan) for m in meta_data], dtype=float)
+        # boolean numpy array, True for rows resampled onto wl_vector from the sample's own wavelengths
+        self.resampled = np.zeros(len(samples), dtype=bool) if resampled is None else resampled
+
+    def __repr__(self):
+        return '<SpectrumTable {} channels:{} samples:{} wavelengths:{}>'.format(
+            self.spec_type, list(self.channels), len(self.samples), len(self.wl_vector))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def channel(self, key):
+        """
+        :param key: y_vectors key, e.g. 'Abs' or 'Cu'
+        :return: 2-D numpy array view of shape (samples, wavelengths)
+        """
+        return self.data[self.channels.index(key)]
+
+    def row_of(self, sample):
+        """
+        :param sample: CQDSample
+        :return: row index of the sample, None if the sample has no spectrum in the table
+        """
+        return self.rows.get(id(sample))
+
+
+class CQDSpectralStore:
+    """
+    Columnar store packing the spectra of a collection into one contiguous array per spectrum type.
+    Spectra measured at other wavelengths are resampled onto a shared wavelength grid per spectrum type.
+    After attach() the CQDSpectrum objects of the samples on the shared grid hold views into the store.
+    """
+    def __init__(self, tables):
+        self.tables = tables  # dict spectrum type -> SpectrumTable
+
+    def __repr__(self):
+        return '<CQDSpectralStore {}>'.format(list(self.tables.values()))
+
+    def __getitem__(self, spec_type):
+        return self.tables[spec_type]
+
+    def __contains__(self, spec_type):
+        return spec_type in self.tables
+
+    @classmethod
+    def from_samples(cls, samples, spec_types=None, grids=None, resample=True):
+        """
+        Pack the spectra of a list of samples. Samples missing a spectrum type are left out of that table.
+        Spectra on another wavelength grid than the table, or with y-vectors shorter than their wl_vector, are
+        resampled in one vectorized step per source grid, see Resampler.
+        :param samples: list of CQDSample
+        :param spec_types: spectrum types to pack, default all types found in the samples
+        :param grids: optional dict{spec_type: wavelengths} of the table grids, default Resampler.common_grid() of
+            the spectra
+        :param resample: if False raise ValueError instead of resampling, the store then holds the spectra as parsed
+        :return: CQDSpectralStore instance
+        """
+        if spec_types is None:
+            spec_types = []
+            for s in samples:
+                spec_types.extend(k for k in s.spectra if k not in spec_types)
+
+        tables = {}
+        for spec_type in spec_types:
+            members = [s for s in samples if s.spectra.get(spec_type) is not None]
+            if not members:
+                continue
+            spectra = [s.spectra[spec_type] for s in members]
+            grid = (grids or {}).get(spec_type)
+            wl_vector = np.array(common_grid([s.wl_vector for s in spectra]) if grid is None else grid, dtype=float)
+            channels = tuple(spectra[0].y_vectors.keys())
+            data = np.empty((len(channels), len(members), len(wl_vector)))
+            over = np.zeros(data.shape, dtype=bool)
+            groups = {}  # grid_key(wl_vector) -> row indexes of spectra to resample
+            for i, (samp, spec) in enumerate(zip(members, spectra)):
+                if tuple(spec.y_vectors.keys()) != channels:
+                    raise ValueError('Error packing {} spectra. Sample {} has different channels'
+                                     .format(spec_type, samp))
+                if not same_grid(wl_vector, spec.wl_vector) or any(len(y) != len(wl_vector)
+                                                                  for y in spec.y_vectors.values()):
+                    if not resample:
+                        raise ValueError('Error packing {} spectra. Sample {} has different wl_vector or y-vectors '
+                                         'shorter than its wl_vector'.format(spec_type, samp))
+                    groups.setdefault(grid_key(spec.wl_vector), []).append(i)
+                    continue
+                for c, key in enumerate(channels):
+                    data[c, i] = spec.y_vectors[key]
+                    over[c, i] = spec.over_mask(key)
+            resampler = resampler_for(wl_vector)
+            for rows in groups.values():
+                x = spectra[rows[0]].wl_vector
+                ys = np.full((len(channels), len(rows), len(x)), np.nan)
+                masks = np.zeros(ys.shape, dtype=bool)
+                for j, i in enumerate(rows):
+                    for c, key in enumerate(channels):
+                        y = spectra[i].y_vectors[key][:len(x)]
+                        ys[c, j, :len(y)] = y
+                        masks[c, j, :len(y)] = spectra[i].over_mask(key)[:len(y)]
+                data[:, rows] = resampler.resample(x, ys)
+                over[:, rows] = resampler.resample_mask(x, masks)
+            resampled = np.zeros(len(members), dtype=bool)
+            for rows in groups.values():
+                resampled[rows] = True
+            tables[spec_type] = SpectrumTable(spec_type, channels, wl_vector, data, members,
+                                              [s.spectra[spec_type].meta_data for s in members], resampled, over)
+        return cls(tables)
+
+    def attach(self):
+        """
+        Replace the arrays of the CQDSpectrum objects with views into the store.
+        Resampled rows are not attached, those spectra keep the wavelengths and values they were measured with.
+        """
+        for table in self.tables.values():
+            for i, samp in enumerate(table.samples):
+                if table.resampled[i]:
+                    continue
+                spec = samp.spectra[table.spec_type]
+                spec.wl_vector = table.wl_vector
+                spec.y_vectors = {key: table.data[c, i] for c, key in enumerate(table.channels)}
+                spec.over = {key: table.over[c, i] for c, key in enumerate(table.channels)}
@@ -1,22 +1,19 @@
 import time
+from functools import lru_cache
 import numpy as np
+from CQD.Resampler import padded, resampler_for, same_grid
 
 
 class CQDSpectrum:
     """Class describing a series of one or more spectra from a Carbon Quantum Dot sample"""
 
-    # Class level attributes for background subtraction
-    bg_abs_x = None
-    bg_abs_y = None
-    bg_ex350_x = None
-    bg_ex350_ys = {}
-    bg_ex400_x = None
-    bg_ex400_ys = {}
-
-    def __init__(self, wl_vector, y_vectors, meta_data):
+    def __init__(self, wl_vector, y_vectors, meta_data, background=None, over=None):
         self.wl_vector = wl_vector  # numpy array of wavelength values
         self.y_vectors = y_vectors  # dictionary of numpy arrays containing y-value (absorbance or fluorescence)
         self.meta_data = meta_data  # dictionary containing metadata of spectra
+        self.background = background  # BackgroundModel used for background subtraction, set by CQDCollection
+        # dictionary of boolean numpy arrays marking saturated ('OVER') points of the y_vectors, see over_mask()
+        self.over = over
 
     @classmethod
     def spectrum_from_xl_data(cls, start_t, end_t, attrib_col, value_col, rows):
@@ -38,79 +35,114 @@ class CQDSpectrum:
             print('{} is not a valid mode'.format(mode))
             return None
 
-        meta_data = {'start_t': time.strptime(start_t, '%Y-%m-%d %H:%M:%S'),
-                     'end_t': time.strptime(end_t, '%Y-%m-%d %H:%M:%S')}
-        wl_vector = row_to_np_array(rows[0])
-        y_vectors = {}
+        meta_data = {'start_t': parse_time(start_t),
+                     'end_t': parse_time(end_t)}
         if mode == 'Abs':
-            y_vectors = {'Abs': row_to_np_array(rows[1])}
-        elif mode == 'Flu':
+            keys = ('Abs',)
+        else:
             meta_data['gain'] = value_col[attrib_col.index('Gain')]
             meta_data['ex_wl'] = value_col[attrib_col.index('Excitation Wavelength')]
-            y_vectors = {'Aq': row_to_np_array(rows[1]),
-                         'Cu': row_to_np_array(rows[2]),
-                         'Fe': row_to_np_array(rows[3]),
-                         'Cd': row_to_np_array(rows[4])}
+            keys = ('Aq', 'Cu', 'Fe', 'Cd')
+        m, over, lengths = rows_to_matrix(rows[:len(keys) + 1])
+        wl_vector = m[0, :lengths[0]]
+        y_vectors = {k: m[i, :lengths[i]] for i, k in enumerate(keys, 1)}
+        # 'OVER' cells are nan in the y_vectors, the mask keeps them apart from nan added by padding or resampling
+        over = {k: over[i, :lengths[i]] for i, k in enumerate(keys, 1)}
 
-        return CQDSpectrum(wl_vector, y_vectors, meta_data)
+        return CQDSpectrum(wl_vector, y_vectors, meta_data, over=over)
+
+    def resampled(self, wl_vector):
+        """
+        Spectrum resampled onto other wavelengths by linear interpolation, see Resampler.
+        Saturated (nan) points stay nan and saturated, wavelengths outside the measured range are nan.
+        :param wl_vector: Numpy.array of wavelengths
+        :return: new CQDSpectrum with the same meta data and background, self if wl_vector is its wavelengths
+        """
+        if same_grid(wl_vector, self.wl_vector) and all(len(y) == len(wl_vector) for y in self.y_vectors.values()):
+            return self
+        resampler = resampler_for(wl_vector)
+        n = len(self.wl_vector)
+        y_vectors = {k: resampler.resample(self.wl_vector, padded(y, n)) for k, y in self.y_vectors.items()}
+        over = {k: resampler.resample_mask(self.wl_vector, padded(self.over_mask(k), n)) for k in self.y_vectors}
+        return CQDSpectrum(resampler.grid, y_vectors, dict(self.meta_data), self.background, over)
+
+    def over_mask(self, spec_key):
+        """
+        :param spec_key: y_vectors key
+        :return: boolean Numpy.array marking the saturated ('OVER') points of the y-vector. Spectra without a
+            stored mask take their nan points as saturated.
+        """
+        if self.over is None:
+            return np.isnan(self.y_vectors[spec_key])
+        return self.over[spec_key]
 
     def subtracted(self, spec_key=None):
         """
-        Performs background subtraction and returns y_vectors.
+        Performs background subtraction with self.background and returns y_vectors.
         If spec_key specified returns only spectrum for the given key.
         :param spec_key:
         :return: dict{key: Numpy.array} or Numpy.array if spec_key specified
         """
-        spectra = self.y_vectors
-        if spec_key is not None:
-            spectra = {spec_key: self.y_vectors[spec_key]}
-
-        # Absorbance spectrum
-        if 'gain' not in self.meta_data:
-            if CQDSpectrum.bg_abs_x is None:
-                raise ValueError('Background spectrum is not initialized')
-
-            if spec_key is not None:
-                return spectra['Abs'] - CQDSpectrum.bg_abs_y
-            return {'Abs': spectra['Abs'] - CQDSpectrum.bg_abs_y}
-
-        # Fluorescence spectrum
-        bg_ys = None
-        if self.meta_data['ex_wl'] == 350:
-            if CQDSpectrum.bg_ex350_x is None:
-                raise ValueError('Background spectra ex350 is not initialized')
-            bg_ys = CQDSpectrum.bg_ex350_ys
-        if self.meta_data['ex_wl'] == 400:
-            if CQDSpectrum.bg_ex400_x is None:
-                raise ValueError('Background spectra ex400 is not initialized')
-            bg_ys = CQDSpectrum.bg_ex400_ys
-
-        gain = self.meta_data['gain']
-        if gain in bg_ys:
-            bg_ys = bg_ys[gain]
-        else:
-            keys = list(bg_ys.keys())
-            try:
-                over = min([x for x in keys if x > gain])
-                under = max([x for x in keys if x < gain])
-            except ValueError:
-                print('Sample gain={} out of range for subtraction. Returning original spectra.'.format(gain))
-                return spectra
-            combined = {}
-            for k in spectra.keys():
-                low = bg_ys[under][k]
-                high = bg_ys[over][k]
-                com_y = low + (high-low) * ((gain-under)/(over-under))
-                combined[k] = com_y
-            bg_ys = combined
+        if self.background is None:
+            raise ValueError('Background spectrum is not initialized')
+        return self.background.subtract(self, spec_key)
+
+
+@lru_cache(maxsize=4096)
+def parse_time(t):
+    """
+    Parses a time stamp string from a spectrometer sheet. Results are cached, blocks of a plate share time stamps.
+    :param t: String: time stamp, e.g. '2024-10-01 10:00:00'
+    :return: time.struct_time
+    """
+    return time.strptime(t, '%Y-%m-%d %H:%M:%S')
 
-        subbed = {}
-        for k in spectra.keys():
-            subbed[k] = spectra[k]-bg_ys[k]
 
-        if spec_key is not None:
-            return subbed[spec_key]
-        return subbed
+def rows_to_matrix(rows):
+    """
+    Converts a block of rows from an Excel worksheet to a float matrix in one step.
+    Like row_to_np_array the first value of each row is dropped, 'OVER' becomes nan and each row ends at the first ''.
+    :param rows: List[List]: rows of cell values
+    :return: (matrix, over, lengths): float numpy array of shape (rows, columns) padded with nan, boolean numpy
+        array marking 'OVER' cells, int numpy array with the length of each row
+    """
+    width = max(len(r) for r in rows) - 1
+    if all(len(r) == width + 1 for r in rows):
+        try:
+            # Fast path, all values numeric
+            m = np.array([r[1:] for r in rows], dtype=float).reshape(len(rows), width)
+            return m, np.zeros(m.shape, dtype=bool), np.full(len(rows), width)
+        except (ValueError, TypeError):
+            pass
+
+    m = np.full((len(rows), width), np.nan)
+    over = np.zeros(m.shape, dtype=bool)
+    lengths = np.zeros(len(rows), dtype=int)
+    for i, r in enumerate(rows):
+        v = r[1:]
+        try:
+            m[i, :len(v)] = v
+            lengths[i] = len(v)
+            continue
+        except (ValueError, TypeError):
+            pass
+        # list.index scans in C, the Python loop only runs once per 'OVER' cell
+        v = list(v)
+        try:
+            del v[v.index(''):]
+        except ValueError:
+            pass
+        j = -1
+        while True:
+            try:
+                j = v.index('OVER', j + 1)
+            except ValueError:
+                break
+            v[j] = np.nan
+            over[i, j] = True
+        m[i, :len(v)] = v
+        lengths[i] = len(v)
+    return m, over, lengths
 
 
 def row_to_np_array(row: list) -> object:
@@ -119,13 +151,5 @@ def row_to_np_array(row: list) -> object:
     :param row: list of cell values from an Excel worksheet
     :return: numpy array
     """
-    row = row[1:]
-    i = 0
-    for c in row:
-        if c == 'OVER':
-            row[i] = 'Nan'
-        if c == '':
-            row = row[:i]
-            break
-        i += 1
-    return np.array(row, dtype=float)
+    m, _, lengths = rows_to_matrix([row])
+    return m[0, :lengths[0]]
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import numpy as np
+from CQD.CQDSpectrum import CQDSpectrum
+
+
+class SpectrumLoader:
+    """
+    Materializes CQDSpectrum objects from the rows of a CQDSpectralStore on demand.
+    The store is typically memory mapped from a cache directory, see CQDCache.load_collection().
+    At most max_resident materialized spectra are kept, the least recently used are dropped first.
+    """
+    def __init__(self, store, max_resident=256):
+        self.store = store  # CQDSpectralStore the spectra are read from
+        self.max_resident = max_resident  # maximum number of materialized spectra kept
+        self.background = None  # BackgroundModel given to materialized spectra
+        self.resident = OrderedDict()  # (spec_type, row) -> CQDSpectrum, least recently used first
+
+    def __repr__(self):
+        return '<SpectrumLoader resident:{}/{}>'.format(len(self.resident), self.max_resident)
+
+    def load(self, spec_type, row):
+        """
+        :param spec_type: spectrum type, table of the store
+        :param row: row of the table
+        :return: CQDSpectrum with its own copies of the arrays
+        """
+        key = (spec_type, row)
+        spectrum = self.resident.get(key)
+        if spectrum is not None:
+            self.resident.move_to_end(key)
+            return spectrum
+        table = self.store[spec_type]
+        spectrum = CQDSpectrum(np.array(table.wl_vector), {k: np.array(table.data[c, row])
+                                                           for c, k in enumerate(table.channels)},
+                               table.meta_data[row], self.background, {k: np.array(table.over[c, row])
+                                                                       for c, k in enumerate(table.channels)})
+        self.resident[key] = spectrum
+        while len(self.resident) > self.max_resident:
+            self.resident.popitem(last=False)
+        return spectrum
+
+    def set_background(self, background):
+        """
+        :param background: BackgroundModel for resident and future materialized spectra
+        """
+        self.background = background
+        for spectrum in self.resident.values():
+            spectrum.background = background
+
+
+class LazySpectra(MutableMapping):
+    """
+    Replacement for the CQDSample.spectra dict that materializes spectra when they are accessed.
+    Spectra read from the store are shared through the loader's LRU, an evicted spectrum is materialized again on
+    the next access, so they should be treated as read-only. Assigned spectra are kept like in a dict.
+    """
+    def __init__(self, loader, rows):
+        """
+        :param loader: SpectrumLoader shared by the samples of a collection
+        :param rows: dict{spec_type: row in the store table or None for an empty spectrum} in spectrum order
+        """
+        self.loader = loader
+        self.rows = dict(rows)
+        self.assigned = {}  # spec_type -> spectrum assigned after loading
+
+    def __repr__(self):
+        return '<LazySpectra {}>'.format(list(self.rows.keys()))
+
+    def __getitem__(self, spec_type):
+        if spec_type in self.assigned:
+            return self.assigned[spec_type]
+        row = self.rows[spec_type]
+        if row is None:
+            return None
+        return self.loader.load(spec_type, row)
+
+    def __setitem__(self, spec_type, spectrum):
+        if spec_type not in self.rows:
+            self.rows[spec_type] = None
+        self.assigned[spec_type] = spectrum
+
+    def __delitem__(self, spec_type):
+        del self.rows[spec_type]
+        self.assigned.pop(spec_type, None)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, spec_type):
+        return spec_type in self.rows
+
+    def __reduce__(self):
+        # Pickled, e.g. for worker processes, as a plain dict of materialized spectra
+        return dict, (list(self.items()),)
+
+    def clear(self):
+        self.rows.clear()
+        self.assigned.clear()
+
+    def loaded(self):
+        """
+        :return: list of spectra already materialized, assigned or resident in the loader
+        """
+        resident = self.loader.resident
+        return list(self.assigned.values()) + [resident[(k, row)] for k, row in self.rows.items()
+                                               if k not in self.assigned and (k, row) in resident]
@@ -0,0 +1,119 @@
+import time
+from contextlib import nullcontext
+
+_no_stage = nullcontext()
+
+
+class PipelineStats:
+    """
+    Wall time and call counts per pipeline stage plus event counters, collected by CQDCollection while reading
+    and writing. A disabled instance does nothing, stage() returns a shared no-op context manager.
+    Usage:
+        stats = PipelineStats()
+        collection = CQDCollection.read_from_dir(path, stats=stats)
+        print(stats.report())
+    """
+    def __init__(self, enabled=True, hook=None):
+        """
+        :param enabled: if False nothing is recorded
+        :param hook: optional callable hook(kind, name, value) called for every record, kind is 'stage' with the
+            elapsed seconds as value or 'count' with the increment as value
+        """
+        self.enabled = enabled
+        self.hook = hook
+        self.times = {}  # stage name -> total wall time in seconds
+        self.calls = {}  # stage name -> number of calls
+        self.counters = {}  # counter name -> count
+
+    def __repr__(self):
+        return '<PipelineStats enabled:{} stages:{} counters:{}>'.format(self.enabled, len(self.times), self.counters)
+
+    def stage(self, name, detail=None):
+        """
+        Context manager timing a stage
+        :param name: stage name, e.g. 'parse_xlsx_sheet'
+        :param detail: optional detail, e.g. sheet name. The time is also recorded for '<name>:<detail>'.
+        :return: context manager
+        """
+        if not self.enabled:
+            return _no_stage
+        return _Stage(self, name, detail)
+
+    def count(self, name, n=1):
+        """
+        Increment a counter
+        :param name: counter name, e.g. 'spectra_parsed'
+        :param n: increment
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.hook is not None:
+            self.hook('count', name, n)
+
+    def counted(self, iterable, name):
+        """
+        :param iterable: iterable to pass through, only wrapped if enabled
+        :param name: counter incremented once per item
+        :return: iterable
+        """
+        if not self.enabled:
+            return iterable
+        return self._counted(iterable, name)
+
+    def _counted(self, iterable, name):
+        n = 0
+        try:
+            for item in iterable:
+                n += 1
+                yield item
+        finally:
+            self.count(name, n)
+
+    def record(self, name, seconds, detail=None):
+        """
+        Add the wall time of one call of a stage, e.g. measured in a worker process
+        :param name: stage name
+        :param seconds: elapsed time
+        :param detail: optional detail, the time is also recorded for '<name>:<detail>', see stage()
+        """
+        if not self.enabled:
+            return
+        self._record(name, seconds)
+        if detail is not None:
+            self._record('{}:{}'.format(name, detail), seconds)
+
+    def _record(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.hook is not None:
+            self.hook('stage', name, seconds)
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+
+    def report(self):
+        """
+        :return: multi-line string with stage times, call counts and counters
+        """
+        lines = ['{:40s} {:>10s} {:>7s}'.format('stage', 'time [ms]', 'calls')]
+        lines += ['{:40s} {:10.1f} {:7d}'.format(name, t * 1e3, self.calls[name]) for name, t in self.times.items()]
+        lines += ['{:40s} {:10d}'.format(name, n) for name, n in self.counters.items()]
+        return '\n'.join(lines)
+
+
+class _Stage:
+    def __init__(self, stats, name, detail):
+        self.stats = stats
+        self.name = name
+        self.detail = detail
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.name, time.perf_counter() - self.start, self.detail)
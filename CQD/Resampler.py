@@ -0,0 +1,165 @@
+import threading
+import numpy as np
+
+# Maximum number of shared resamplers kept by resampler_for() and of source grids cached per resampler
+cache_size = 64
+
+
+class Resampler:
+    """
+    Linear interpolation of spectra onto a fixed wavelength grid, vectorized over any number of spectra.
+    The interpolation weights are computed once per source grid and cached, for at most cache_size source grids,
+    the oldest are dropped first. Grid points outside the range of the source grid and points interpolated from a
+    saturated ('OVER', nan) value are nan, so the saturation mask carries over to the grid.
+    """
+    def __init__(self, grid):
+        """
+        :param grid: increasing wavelengths to resample onto
+        """
+        self.grid = np.array(grid, dtype=float)
+        self.grid.setflags(write=False)
+        self.weights = {}  # grid_key(source grid) -> (left, right, w, outside), see interpolation_weights()
+
+    def __repr__(self):
+        return '<Resampler wavelengths:{} source grids:{}>'.format(len(self.grid), len(self.weights))
+
+    def is_grid(self, x):
+        """
+        :param x: wavelengths
+        :return: True if x is the grid of the resampler
+        """
+        return same_grid(x, self.grid)
+
+    def resample(self, x, ys):
+        """
+        :param x: increasing source wavelengths
+        :param ys: numpy array of shape (..., len(x)), e.g. (channels, spectra, wavelengths)
+        :return: numpy array of shape (..., len(grid)), ys itself if x is the grid
+        """
+        if self.is_grid(x):
+            return ys
+        key = grid_key(x)
+        weights = self.weights.get(key)
+        if weights is None:
+            weights = interpolation_weights(np.asarray(x, dtype=float), self.grid)
+            with _lock:
+                _evict(self.weights)
+                self.weights[key] = weights
+        left, right, w, outside = weights
+        ys = np.asarray(ys, dtype=float)
+        out = ys[..., left] * (1 - w) + ys[..., right] * w
+        out[..., outside] = np.nan
+        return out
+
+    def resample_mask(self, x, masks):
+        """
+        :param x: increasing source wavelengths
+        :param masks: numpy array of shape (..., len(x)), True for marked points, e.g. the saturated points of
+            spectra. nan, e.g. padding, counts as unmarked.
+        :return: boolean numpy array of shape (..., len(grid)), grid points interpolated from a marked point are
+            marked, grid points outside the range of x are not
+        """
+        return np.nan_to_num(self.resample(x, np.asarray(masks, dtype=float)), nan=0.0) > 0
+
+
+# Resamplers by grid in order of creation, see resampler_for()
+_resamplers = {}
+_lock = threading.Lock()
+
+
+def resampler_for(grid):
+    """
+    :param grid: wavelengths
+    :return: shared Resampler onto grid, created on first use. At most cache_size resamplers are kept, the oldest
+        is dropped first.
+    """
+    key = grid_key(grid)
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        with _lock:
+            resampler = _resamplers.get(key)
+            if resampler is None:
+                _evict(_resamplers)
+                resampler = _resamplers[key] = Resampler(grid)
+    return resampler
+
+
+def _evict(cache):
+    # Drop the oldest entries of a dict so one more fits in cache_size, called with _lock held
+    while len(cache) >= cache_size:
+        del cache[next(iter(cache))]
+
+
+def same_grid(a, b):
+    """
+    :param a: wavelengths
+    :param b: wavelengths
+    :return: True if a and b are the same wavelengths
+    """
+    # Comparing the bytes is several times faster than np.array_equal for short float arrays, arrays of another
+    # dtype compare unequal and are resampled, which is exact on equal wavelengths
+    return a is b or (len(a) == len(b) and np.asarray(a).tobytes() == np.asarray(b).tobytes())
+
+
+def grid_key(x):
+    """
+    :param x: wavelengths
+    :return: hashable key identifying the grid
+    """
+    x = np.asarray(x, dtype=float)
+    return len(x), x.tobytes()
+
+
+def interpolation_weights(x, grid):
+    """
+    :param x: increasing source wavelengths
+    :param grid: wavelengths to interpolate at
+    :return: (left, right, w, outside): indexes of the neighbouring source points and weight of the right one for
+        each grid point, boolean mask of grid points outside the range of x
+    """
+    outside = (grid < x[0]) | (grid > x[-1])
+    if len(x) < 2:
+        zeros = np.zeros(len(grid), dtype=int)
+        return zeros, zeros, np.zeros(len(grid)), grid != x[0]
+    right = np.clip(np.searchsorted(x, grid), 1, len(x) - 1)
+    left = right - 1
+    w = np.clip((grid - x[left]) / (x[right] - x[left]), 0, 1)
+    # Grid points on a source point take only that point, a nan neighbour with weight 0 must not spread
+    left = np.where(w == 1, right, left)
+    right = np.where(w == 0, left, right)
+    return left, right, w, outside
+
+
+def common_grid(wl_vectors):
+    """
+    Shared wavelength grid of a set of spectra
+    :param wl_vectors: list of increasing wavelength arrays
+    :return: the wavelengths if all are equal, otherwise the overlapping range of all of them with the smallest step
+        found in any of them
+    """
+    grids = {grid_key(x): np.asarray(x, dtype=float) for x in wl_vectors}
+    if len(grids) == 1:
+        return next(iter(grids.values()))
+    start = max(x[0] for x in grids.values())
+    stop = min(x[-1] for x in grids.values())
+    if stop < start:
+        raise ValueError('Wavelength ranges {} do not overlap'.format([(x[0], x[-1]) for x in grids.values()]))
+    steps = [np.min(np.diff(x)) for x in grids.values() if len(x) > 1]
+    if not steps or stop == start:
+        return np.array([start])
+    step = min(steps)
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1)
+
+
+def padded(y, n):
+    """
+    Rows are cut at the first blank cell when read, so a y-vector can be shorter than its wl_vector
+    :param y: numpy array
+    :param n: length of the wl_vector
+    :return: y padded with nan or cut to length n, y itself if it has length n
+    """
+    if len(y) == n:
+        return y
+    out = np.full(n, np.nan)
+    out[:min(n, len(y))] = y[:n]
+    return out
@@ -0,0 +1,141 @@
+import numpy as np
+from CQD import CQDQuench
+from CQD.Resampler import resampler_for
+
+# Similarity measures of SpectralIndex
+metrics = ('cosine', 'correlation')
+growth = 1.25  # factor the vector matrix grows by when full, the unused rows are at most a fifth of it
+
+
+class SpectralIndex:
+    """
+    Nearest neighbour search over the spectra of one spectrum type by cosine similarity or correlation.
+    The channels of a spectrum are resampled onto a common wavelength grid and concatenated into one vector,
+    e.g. Aq, Cu, Fe, Cd for the emission shape together with the quench pattern. Vectors are normalized to unit
+    length, centered first for correlation, so the scores of a query against all spectra are one matrix-vector
+    product. Saturated points (nan) count as 0 after centering.
+    Usage:
+        index = collection.spectral_index('ex350')
+        for plate in CQDCollection.iter_plates(path):
+            index.add_collection(plate)
+        index.trim()
+        index.neighbours(sample, k=5)
+    """
+    def __init__(self, spec_type, wl_grid, channels, metric='correlation', capacity=1024):
+        """
+        :param spec_type: spectrum type of the indexed spectra, e.g. 'ex350'
+        :param wl_grid: wavelengths the spectra are resampled onto
+        :param channels: y_vectors keys concatenated into the vector of a spectrum
+        :param metric: 'cosine' or 'correlation'
+        :param capacity: initial number of rows of the vector matrix, grown by the factor growth when full
+        """
+        if metric not in metrics:
+            raise ValueError('Unknown similarity metric {}, expected one of {}'.format(metric, list(metrics)))
+        self.spec_type = spec_type
+        self.wl_grid = np.array(wl_grid, dtype=float)
+        self.channels = tuple(channels)
+        self.metric = metric
+        self.vectors = np.zeros((max(1, capacity), len(self.channels) * len(self.wl_grid)), dtype=np.float32)
+        self.samples = []  # list of CQDSample, row index of vectors -> sample
+        self.rows = {}  # id(sample) -> row index
+
+    def __repr__(self):
+        return '<SpectralIndex {} {} channels:{} samples:{} wavelengths:{}>'.format(
+            self.spec_type, self.metric, list(self.channels), len(self.samples), len(self.wl_grid))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def vectorize(self, wl_vector, data, channels=None):
+        """
+        :param wl_vector: wavelengths of data
+        :param data: numpy array of shape (channels, spectra, wavelengths)
+        :param channels: channel keys of the first axis of data, default the channels of the index
+        :return: normalized float32 numpy array of shape (spectra, vector length)
+        """
+        if channels is not None and tuple(channels) != self.channels:
+            data = data[[tuple(channels).index(c) for c in self.channels]]
+        ys = resampler_for(self.wl_grid).resample(np.asarray(wl_vector, dtype=float), np.asarray(data, dtype=float))
+        v = ys.transpose(1, 0, 2).reshape(ys.shape[1], -1)
+        if self.metric == 'correlation':
+            valid = ~np.isnan(v)
+            n = valid.sum(axis=1, keepdims=True)
+            v = v - np.where(valid, v, 0).sum(axis=1, keepdims=True) / np.maximum(n, 1)
+        v = np.nan_to_num(v, nan=0.0)
+        norm = np.linalg.norm(v, axis=1, keepdims=True)
+        return (v / np.where(norm > 0, norm, 1)).astype(np.float32)
+
+    def add(self, samples, wl_vector, data, channels=None):
+        """
+        Add or replace the spectra of samples, vectorized over all of them
+        :param samples: list of CQDSample, one per spectrum. Samples already in the index get their row replaced.
+        :param wl_vector: wavelengths of data
+        :param data: numpy array of shape (channels, samples, wavelengths)
+        :param channels: channel keys of the first axis of data, default the channels of the index
+        """
+        if len(samples) == 0:
+            return
+        v = self.vectorize(wl_vector, data, channels)
+        rows = []
+        for sample in samples:
+            row = self.rows.get(id(sample))
+            if row is None:
+                row = self.rows[id(sample)] = len(self.samples)
+                self.samples.append(sample)
+            rows.append(row)
+        if len(self.samples) > len(self.vectors):
+            grown = np.zeros((max(len(self.samples), int(growth * len(self.vectors))), self.vectors.shape[1]),
+                             dtype=np.float32)
+            grown[:len(self.vectors)] = self.vectors
+            self.vectors = grown
+        self.vectors[rows] = v
+
+    def add_collection(self, collection, subtract=True):
+        """
+        Add the spectra of a collection, e.g. a plate from CQDCollection.iter_plates()
+        :param collection: CQDCollection, its store is built if needed
+        :param subtract: if True index background subtracted spectra, see CQDCollection.subtract_all()
+        """
+        if collection.store is None:
+            collection.build_store()
+        if self.spec_type not in collection.store:
+            return
+        table = collection.store[self.spec_type]
+        data = collection.subtract_all([self.spec_type])[self.spec_type] if subtract else table.data
+        self.add(table.samples, table.wl_vector, data, table.channels)
+
+    def trim(self):
+        """
+        Release the unused rows of the vector matrix, e.g. after the last add_collection() of an index built
+        plate by plate. Spectra can still be added afterwards.
+        """
+        if len(self.vectors) > max(1, len(self.samples)):
+            self.vectors = self.vectors[:max(1, len(self.samples))].copy()
+
+    def query(self, wl_vector, y_vectors, k=10):
+        """
+        :param wl_vector: wavelengths of the query spectrum
+        :param y_vectors: dict{channel: numpy array} of the query spectrum, e.g. CQDSpectrum.subtracted()
+        :param k: number of neighbours
+        :return: list of (sample, score) of the k most similar spectra, most similar first
+        """
+        data = np.array([y_vectors[c] for c in self.channels], dtype=float)[:, None]
+        return self._top_k(self.vectorize(wl_vector, data)[0], k)
+
+    def neighbours(self, sample, k=10):
+        """
+        :param sample: CQDSample in the index
+        :param k: number of neighbours
+        :return: list of (sample, score) of the k most similar other spectra, most similar first
+        """
+        row = self.rows.get(id(sample))
+        if row is None:
+            raise ValueError('Sample {} is not in the {} index'.format(sample, self.spec_type))
+        return self._top_k(self.vectors[row], k, exclude=row)
+
+    def _top_k(self, vector, k, exclude=None):
+        scores = self.vectors[:len(self.samples)] @ vector
+        if exclude is not None:
+            scores[exclude] = np.nan
+        return [(self.samples[i], float(scores[i])) for i in CQDQuench.top_n(scores, k, largest=True)]
+
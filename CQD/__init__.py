@@ -1,5 +1,10 @@
-__all__ = ["CQDCollection", "CQDSpectrum", "CQDSample"]
+__all__ = ["CQDCollection", "CQDSpectrum", "CQDSample", "CQDSpectralStore", "BackgroundModel", "PipelineStats",
+           "SpectralIndex"]
 
 from .CQDCollection import CQDCollection
 from .CQDSample import CQDSample
 from .CQDSpectrum import CQDSpectrum
+from .CQDSpectralStore import CQDSpectralStore
+from .BackgroundModel import BackgroundModel
+from .PipelineStats import PipelineStats
+from .SpectralIndex import SpectralIndex
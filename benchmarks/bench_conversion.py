@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of the cell conversion on the spectrum read and write paths.
+Compares the per-cell conversion loops with the bulk conversion in CQD on rows of a full-size plate sheet.
+Run from the repository root: python -m benchmarks.bench_conversion
+"""
+import random
+import time
+import numpy as np
+from CQD.CQDSpectrum import CQDSpectrum, rows_to_matrix
+from CQD.CQDSample import to_list_nan
+
+wells = 24  # wells per plate
+wl_points = 501  # wavelength points per spectrum
+saturated_rates = (0.0, 0.1)  # fractions of data rows with a saturated ('OVER') region
+saturated_width = 40  # number of 'OVER' cells in a saturated region
+
+
+def legacy_row_to_np_array(row):
+    row = row[1:]
+    i = 0
+    for c in row:
+        if c == 'OVER':
+            row[i] = 'Nan'
+        if c == '':
+            row = row[:i]
+            break
+        i += 1
+    return np.array(row, dtype=float)
+
+
+def legacy_to_list_nan(vec):
+    li = vec.tolist()
+    return ['Nan' if np.isnan(x) else x for x in li]
+
+
+def legacy_spectrum_from_xl_data(start_t, end_t, rows):
+    meta_data = {'start_t': time.strptime(start_t, '%Y-%m-%d %H:%M:%S'),
+                 'end_t': time.strptime(end_t, '%Y-%m-%d %H:%M:%S')}
+    return meta_data, [legacy_row_to_np_array(r) for r in rows]
+
+
+def plate_blocks(rng, saturated_rate):
+    """Raw rows of the 3 spectrum blocks (abs, ex350, ex400) of every well of one plate"""
+    wl_row = ['Wavel.'] + [300 + i for i in range(wl_points)]
+    blocks = []
+    for w in range(wells):
+        for n_rows in (1, 4, 4):
+            rows = [list(wl_row)]
+            for r in range(n_rows):
+                values = [rng.random() * 1000 for _ in range(wl_points)]
+                if rng.random() < saturated_rate:
+                    start = rng.randrange(wl_points - saturated_width)
+                    values[start:start + saturated_width] = ['OVER'] * saturated_width
+                rows.append(['A{}'.format(r + 1)] + values)
+            blocks.append(rows)
+    return blocks
+
+
+def best_of(f, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    for saturated_rate in saturated_rates:
+        run(saturated_rate)
+
+
+def run(saturated_rate):
+    rng = random.Random(0)
+    blocks = plate_blocks(rng, saturated_rate)
+    attrib_col = ['Mode', 'Gain', 'Excitation Wavelength']
+    st, et = '2024-10-01 10:00:00', '2024-10-01 10:05:00'
+
+    def legacy_read():
+        for rows in blocks:
+            legacy_spectrum_from_xl_data(st, et, rows)
+
+    def bulk_read():
+        for rows in blocks:
+            mode = 'Absorbance' if len(rows) == 2 else 'Fluorescence Top Reading'
+            CQDSpectrum.spectrum_from_xl_data(st, et, attrib_col, [mode, 50, 350], rows)
+
+    vecs = [rows_to_matrix(rows)[0] for rows in blocks]
+
+    def legacy_write():
+        for m in vecs:
+            for v in m:
+                legacy_to_list_nan(v)
+
+    def bulk_write():
+        for m in vecs:
+            for v in m:
+                to_list_nan(v)
+
+    print('Plate sheet: {} wells, {} blocks, {} wavelengths, {:.0%} saturated rows'.format(
+        wells, len(blocks), wl_points, saturated_rate))
+    for name, legacy, bulk in (('read', legacy_read, bulk_read), ('write', legacy_write, bulk_write)):
+        t_legacy = best_of(legacy)
+        t_bulk = best_of(bulk)
+        print('{:6s} legacy {:8.2f} ms  bulk {:8.2f} ms  speedup {:5.1f}x'.format(
+            name, t_legacy * 1e3, t_bulk * 1e3, t_legacy / t_bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark of the main steps of the pipeline on a synthetic data directory, see benchmarks.synthetic.
+Times read_from_dir, background subtraction, report writing and the quality control of the findMissingOver notebook,
+records the peak traced memory of each step and writes the results as json for comparison across commits.
+Run from the repository root: python -m benchmarks.bench_pipeline --plates 10 --output results.json
+Compare two result files: python -m benchmarks.bench_pipeline --compare old.json new.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from CQD import CQDCollection
+from benchmarks.synthetic import generate_dataset
+
+
+def qc_notebook(samples):
+    """Quality control as in findMissingOver.ipynb, results collected instead of printed"""
+    missing = [(s.label, list(s.spectra.keys())) for s in samples if len(s.spectra) != 3]
+    over = []
+    for s in sorted(samples, key=lambda x: (x.plate, x.well)):
+        for spec_type in ('abs', 'ex350', 'ex400'):
+            if spec_type not in s.spectra:
+                continue
+            for k, spec in s.spectra[spec_type].y_vectors.items():
+                n = np.count_nonzero(np.isnan(spec))
+                if n:
+                    over.append((s.label, spec_type, k, n))
+    return missing, over
+
+
+def subtract_each(samples):
+    """Background subtraction one spectrum at a time with CQDSpectrum.subtracted()"""
+    return [spec.subtracted() for s in samples for spec in s.spectra.values() if spec is not None]
+
+
+def measure(f, repeat, memory):
+    """
+    :param f: function to benchmark
+    :param repeat: number of timed runs
+    :param memory: if True make one more run with tracemalloc for the peak memory
+    :return: dict with best and mean time in seconds and peak memory in MB (None if not measured)
+    """
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        f()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return {'best_s': min(times), 'mean_s': sum(times) / len(times), 'peak_mb': peak}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(plates, wells, wl_points, over_rate, repeat, memory, data_dir=None):
+    """
+    Generate a data set and benchmark the pipeline steps on it
+    :return: dict of results, see main()
+    """
+    params = {'plates': plates, 'wells': wells, 'wl_points': wl_points, 'over_rate': over_rate, 'repeat': repeat}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = data_dir or os.path.join(tmp, 'data')
+        t = time.perf_counter()
+        generate_dataset(path, plates, wells, wl_points, over_rate)
+        generate_s = time.perf_counter() - t
+
+        results['read_from_dir'] = measure(lambda: CQDCollection.read_from_dir(path), repeat, memory)
+        collection = CQDCollection.read_from_dir(path)
+        samples = collection.samples
+        results['subtracted'] = measure(lambda: subtract_each(samples), repeat, memory)
+        results['subtract_all'] = measure(collection.subtract_all, repeat, memory)
+        results['write_work_sheet'] = measure(lambda: collection.write_reports(os.path.join(tmp, 'reports')),
+                                              repeat, memory)
+        results['qc_notebook'] = measure(lambda: qc_notebook(samples), repeat, memory)
+        results['qc_report'] = measure(collection.qc_report, repeat, memory)
+
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'params': params,
+            'samples': len(samples),
+            'generate_s': generate_s,
+            'results': results}
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    if old['params'] != new['params']:
+        print('Warning: different parameters {} and {}'.format(old['params'], new['params']))
+    print('{:18s} {:>10s} {:>10s} {:>8s}'.format('step', 'old [ms]', 'new [ms]', 'ratio'))
+    for step, r in new['results'].items():
+        if step not in old['results']:
+            continue
+        t_old = old['results'][step]['best_s']
+        print('{:18s} {:10.1f} {:10.1f} {:8.2f}'.format(step, t_old * 1e3, r['best_s'] * 1e3, r['best_s'] / t_old))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plates', type=int, default=3)
+    parser.add_argument('--wells', type=int, default=24)
+    parser.add_argument('--wl-points', type=int, default=501)
+    parser.add_argument('--over-rate', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--data-dir', help='keep the generated data in this directory')
+    parser.add_argument('--output', help='json file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run(args.plates, args.wells, args.wl_points, args.over_rate, args.repeat, not args.no_memory,
+                 args.data_dir)
+    print('{} samples, {} plates, {} wavelengths, commit {}'.format(
+        result['samples'], args.plates, args.wl_points, result['commit']))
+    for step, r in result['results'].items():
+        peak = '' if r['peak_mb'] is None else '{:8.1f} MB'.format(r['peak_mb'])
+        print('{:18s} {:10.1f} ms {}'.format(step, r['best_s'] * 1e3, peak))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
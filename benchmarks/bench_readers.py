@@ -0,0 +1,85 @@
+"""
+Benchmark of the worksheet reader backends on a synthetic data directory, see CQD.CQDReaders.
+Times reading the rows of every worksheet and read_from_dir() per backend and checks that the backends give equal
+spectra. Run from the repository root: python -m benchmarks.bench_readers --plates 10
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from CQD import CQDCollection
+from CQD.CQDCollection import data_paths
+from CQD.CQDReaders import open_reader
+from benchmarks.synthetic import generate_dataset
+
+xlsx_backends = ('openpyxl', 'ooxml')
+
+
+def read_rows(path, backend):
+    """
+    :return: number of rows in all worksheets of the workbook
+    """
+    with open_reader(path, backend) as reader:
+        return sum(sum(1 for _ in reader.iter_rows(sheet_name)) for sheet_name in reader.sheet_names)
+
+
+def spectra_equal(a, b):
+    """
+    :param a: CQDCollection
+    :param b: CQDCollection read from the same directory
+    :return: True if all samples have equal spectra, nan compared equal
+    """
+    for sa, sb in zip(a.samples, b.samples):
+        if sa.spectra.keys() != sb.spectra.keys():
+            return False
+        for spec_type, x in sa.spectra.items():
+            y = sb.spectra[spec_type]
+            if (x.meta_data != y.meta_data or not np.array_equal(x.wl_vector, y.wl_vector)
+                    or x.y_vectors.keys() != y.y_vectors.keys()
+                    or not all(np.array_equal(v, y.y_vectors[k], equal_nan=True) for k, v in x.y_vectors.items())):
+                return False
+    return len(a.samples) == len(b.samples)
+
+
+def best_time(f, repeat):
+    """
+    :return: (best wall time in seconds, result of the last call)
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plates', type=int, default=3)
+    parser.add_argument('--wl-points', type=int, default=501)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', help='read this data directory instead of generating one')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.data_dir
+        if path is None:
+            path = os.path.join(tmp, 'data')
+            generate_dataset(path, args.plates, wl_points=args.wl_points)
+        cqd2_path = data_paths(path)[0]
+
+        reference = None
+        print('{:10s} {:>12s} {:>16s} {:>8s}'.format('backend', 'rows [ms]', 'read_from_dir [ms]', 'equal'))
+        for backend in xlsx_backends:
+            t_rows, _ = best_time(lambda: read_rows(cqd2_path, backend), args.repeat)
+            t_read, collection = best_time(lambda: CQDCollection.read_from_dir(path, backend=backend), args.repeat)
+            if reference is None:
+                reference = collection
+            print('{:10s} {:12.1f} {:16.1f} {:>8}'.format(backend, t_rows * 1e3, t_read * 1e3,
+                                                         str(spectra_equal(reference, collection))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Synthetic input files in the layout read by CQDCollection.read_from_dir():
+a measurement workbook with one sheet per plate, the well plate map and the fluorescence baseline file.
+Run from the repository root to write a data directory: python -m benchmarks.synthetic <dir> [plates]
+"""
+import os
+import random
+import sys
+from openpyxl import Workbook
+from CQD.CQDCollection import blank_sample_comments, data_paths
+
+baseline_gains = (50, 60, 80, 100)  # gains of the fluorescence baseline spectra
+sample_gains = (50, 60, 70, 80, 90)  # gains of the sample spectra, all within the baseline range
+klasses = 8  # number of school classes
+reactants = ('Citronsyra', 'Urea', 'Glukos', 'Etylendiamin', 'Cu', 'Fe')
+saturated_width = 40  # number of 'OVER' cells in a saturated region
+abs_start = 250  # first wavelength of absorbance spectra
+flu_start = 380  # first wavelength of fluorescence spectra
+
+
+def generate_dataset(path, plates=3, wells=24, wl_points=501, over_rate=0.05, seed=0):
+    """
+    Write a synthetic data directory
+    :param path: directory to write the files to, created if missing
+    :param plates: number of plates, one worksheet each
+    :param wells: number of wells with a sample per plate, at most 24
+    :param wl_points: number of wavelength points per spectrum
+    :param over_rate: fraction of data rows with a saturated ('OVER') region
+    :param seed: random seed
+    :return: list of paths of the measurement workbook, the well plate map and the baseline file
+    """
+    if not 0 < wells <= 24:
+        raise ValueError('Number of wells must be between 1 and 24, got {}'.format(wells))
+    os.makedirs(path, exist_ok=True)
+    rng = random.Random(seed)
+    cqd2_path, map_path, flu_bg_path = [os.path.join(path, name) for name in (
+        'CQD_measurements_abs adjusted_fluor adjusted.xlsx', 'Well plate map_7oct24.xlsx',
+        'Fluorescence baseline.xlsx')]
+
+    map_book = Workbook(write_only=True)
+    ms = map_book.create_sheet('Map')
+    book = Workbook(write_only=True)
+    for plate in range(1, plates + 1):
+        ms.append(['Plate', plate])
+        ws = book.create_sheet('Plate {}'.format(plate))
+        for well in range(1, wells + 1):
+            blank = well % 12 == 0
+            row_name = {1: 'A', 13: 'E'}.get(well)
+            comment = rng.choice(blank_sample_comments) if blank else (None if rng.random() < 0.8 else 'grumligt')
+            ms.append([row_name, (well - 1) % 12 + 1, 'P{}-{}'.format(plate, well)]
+                      + rng.sample(reactants, 2) + ['Klass {}'.format(rng.randrange(klasses)), comment])
+
+            t = '2024-10-{:02d} {:02d}:{:02d}:00'.format(plate % 28 + 1, 8 + well // 6, well % 60)
+            write_block(ws, str(well), 'Absorbance', None, None, abs_start, t,
+                        [spectrum_row(rng, 'A1', wl_points, 0.05 if blank else 2.0, over_rate)])
+            for ex_wl, suffix in ((350, 'a'), (400, 'b')):
+                gain = rng.choice(sample_gains)
+                write_block(ws, '{}{}'.format(well, suffix), 'Fluorescence Top Reading', gain, ex_wl, flu_start, t,
+                            [spectrum_row(rng, name, wl_points, 20 * gain * (0.1 if blank else 1), over_rate)
+                             for name in ('A1', 'B1', 'C1', 'D1')])
+    book.save(cqd2_path)
+    map_book.save(map_path)
+
+    bg_book = Workbook(write_only=True)
+    ws = bg_book.create_sheet('Baseline')
+    for ex_wl in (350, 400):
+        for gain in baseline_gains:
+            write_block(ws, 'B{}'.format(gain), 'Fluorescence Top Reading', gain, ex_wl, flu_start,
+                        '2024-10-01 07:00:00', [spectrum_row(rng, name, wl_points, gain, 0)
+                                                for name in ('A1', 'B1', 'C1', 'D1')])
+    bg_book.save(flu_bg_path)
+    return data_paths(path)
+
+
+def write_block(ws, label, mode, gain, ex_wl, wl_start, t, rows):
+    """
+    Append one spectrometer data block to a worksheet
+    :param ws: worksheet
+    :param label: well label without 'Label: ', e.g. '3a'
+    :param mode: 'Absorbance' or 'Fluorescence Top Reading'
+    :param gain: gain of fluorescence blocks
+    :param ex_wl: excitation wavelength of fluorescence blocks
+    :param wl_start: first wavelength
+    :param t: start time string
+    :param rows: data rows, see spectrum_row()
+    """
+    ws.append(['Label: ' + label])
+    ws.append(['Mode', None, None, None, mode])
+    ws.append(['Wavelength start', None, None, None, wl_start])
+    ws.append(['Wavelength step size', None, None, None, 1])
+    if mode != 'Absorbance':
+        ws.append(['Excitation Wavelength', None, None, None, ex_wl])
+        ws.append(['Gain', None, None, None, gain])
+    ws.append(['Start Time:', t])
+    ws.append([])
+    ws.append(['Wavel.'] + list(range(wl_start, wl_start + len(rows[0]) - 1)))
+    for row in rows:
+        ws.append(row)
+    ws.append([])
+    ws.append(['End Time:', t])
+    ws.append([])
+
+
+def spectrum_row(rng, name, wl_points, scale, over_rate):
+    """
+    :return: data row of a spectrum with one noisy peak, with a saturated region at the peak at rate over_rate
+    """
+    center = rng.uniform(0.2, 0.8) * wl_points
+    width = rng.uniform(0.05, 0.15) * wl_points
+    values = [round(scale * (2.718281828 ** (-0.5 * ((i - center) / width) ** 2) + 0.05 * rng.random()), 4)
+              for i in range(wl_points)]
+    if rng.random() < over_rate:
+        start = max(0, min(int(center) - saturated_width // 2, wl_points - saturated_width))
+        values[start:start + saturated_width] = ['OVER'] * min(saturated_width, wl_points)
+    return [name] + values
+
+
+if __name__ == '__main__':
+    generate_dataset(sys.argv[1], *[int(x) for x in sys.argv[2:3]])